@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Benchmark ActionControllerMixin with many actions
+
+Constructs controllers (GObjects, like MainWindow and EditorBook) having
+500 on_<Action> callbacks, connecting each to its own ActionGroup, with
+the per-instance inspect.getmembers() scan used before and with the
+per-class cached table.
+"""
+
+import sys
+import os.path
+import inspect
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir, 'lib'))
+
+import pygtk
+pygtk.require('2.0')
+import gobject
+import gtk
+
+# gtkutil needs the context to be initialized
+import mallet.context
+mallet.context.init_context(lambda: None)
+from mallet.gtkutil import ActionControllerMixin
+
+NR_ACTIONS = 500
+NR_CONTROLLERS = 50
+
+
+class ScanningMixin:
+
+    """The previous implementation: inspect every member of every instance"""
+
+    def connectActionCallbacks(self, action_group):
+        methods = [x[0] for x in inspect.getmembers(self) \
+                   if inspect.ismethod(x[1])]
+        actions_list = [x[3:] for x in methods if x.startswith('on_')]
+        for action_name in actions_list:
+            action = action_group.get_action(action_name)
+            action.connect("activate", getattr(self, 'on_%s' % action_name))
+
+
+def make_controller_class(mixin):
+    def callback(self, action):
+        pass
+    namespace = {}
+    for i in range(NR_ACTIONS):
+        namespace['on_Action%d' % i] = callback
+    def __init__(self, action_group):
+        gobject.GObject.__init__(self)
+        self.connectActionCallbacks(action_group)
+    namespace['__init__'] = __init__
+    return type('Controller', (gobject.GObject, mixin), namespace)
+
+
+def make_action_group():
+    action_group = gtk.ActionGroup('Benchmark')
+    action_group.add_actions([('Action%d' % i, None, 'Action %d' % i)
+                              for i in range(NR_ACTIONS)])
+    return action_group
+
+
+def measure(mixin):
+    cls = make_controller_class(mixin)
+    groups = [make_action_group() for i in range(NR_CONTROLLERS)]
+    start = time.time()
+    for action_group in groups:
+        cls(action_group)
+    return time.time() - start
+
+
+def main():
+    print '%d controllers with %d actions each' % (NR_CONTROLLERS, NR_ACTIONS)
+    print 'getmembers scan:  %.3fs' % measure(ScanningMixin)
+    print 'cached table:     %.3fs' % measure(ActionControllerMixin)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Benchmark saving a SourceBuffer: whole-text copy vs streamed atomic write
+
+Each measurement runs in a forked child so that the peak RSS reported is
+the growth caused by the save alone (over the RSS with the buffer filled).
+
+    $ benchmarks/save.py [size-in-MB ...]
+"""
+
+import sys
+import os
+import time
+import resource
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir, 'lib'))
+
+import gtksourceview as gsv
+
+from mallet.util import atomicWrite
+
+SIZES = [1, 10, 100, 500] # MB
+LINE = 'x = some_function(argument, another_argument) # %s\n' % ('.' * 20)
+
+
+def fill_buffer(size):
+    buffer = gsv.SourceBuffer()
+    block = LINE * (1024 * 1024 / len(LINE))
+    for i in range(size):
+        buffer.insert(buffer.get_end_iter(), block)
+    return buffer
+
+
+def iter_text(buffer, chunk_size=65536):
+    # same as Editor.iterText
+    start = buffer.get_start_iter()
+    while not start.is_end():
+        end = start.copy()
+        end.forward_chars(chunk_size)
+        yield buffer.get_text(start, end)
+        start = end
+
+
+def save_copy(buffer, filename):
+    start, end = buffer.get_bounds()
+    text = buffer.get_text(start, end)
+    open(filename, 'w').write(text)
+
+
+def save_stream(buffer, filename):
+    atomicWrite(filename, iter_text(buffer))
+
+
+def measure(size, save, filename):
+    """Return (seconds, peak RSS growth in KB) of `save` in a child"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        buffer = fill_buffer(size)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        save(buffer, filename)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, '%f %d' % (elapsed, after - before))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 100)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    elapsed, rss = result.split()
+    return float(elapsed), int(rss)
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    print '%8s %22s %22s' % ('size', 'copy (s / peak KB)', 'stream (s / peak KB)')
+    try:
+        for size in sizes:
+            copy = measure(size, save_copy, filename)
+            stream = measure(size, save_stream, filename)
+            print '%6dMB %12.3f / %7d %12.3f / %7d' % ((size,) + copy + stream)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
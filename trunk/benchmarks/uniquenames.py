@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software 
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Micro-benchmark for UniqueNames
+
+Adds and then removes 10k paths where every path shares one of a handful
+of basenames (think of a tree full of __init__.py files).
+"""
+
+import sys
+import os.path
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir, 'lib'))
+
+from mallet.util import UniqueNames
+
+NR_PATHS = 10000
+BASENAMES = ['__init__.py', 'setup.py', 'main.py']
+
+
+def make_paths(n):
+    paths = []
+    for i in range(n):
+        dirs = ['pkg%d' % (i % 7), 'sub%d' % (i % 13), 'mod%d' % i]
+        paths.append('/' + '/'.join(dirs + [BASENAMES[i % len(BASENAMES)]]))
+    return paths
+
+
+def main():
+    paths = make_paths(NR_PATHS)
+    names = UniqueNames()
+    notified = [0]
+    def changed(shortname):
+        notified[0] += 1
+
+    start = time.time()
+    for path in paths:
+        names.addPath(path, changed)
+    added = time.time()
+    for path in paths:
+        names.removePath(path)
+    removed = time.time()
+
+    print 'paths:          %d' % NR_PATHS
+    print 'add:            %.3fs' % (added - start)
+    print 'remove:         %.3fs' % (removed - added)
+    print 'notifications:  %d' % notified[0]
+
+
+if __name__ == '__main__':
+    main()
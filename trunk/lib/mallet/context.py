@@ -20,9 +20,17 @@ Context object is shared between many modules and plugins. Context object
 help client to access the internals such as configuration, main window, etc..
 """
 
+import os
 import os.path
 import inspect
-import syck, ydump
+import struct
+import marshal
+import fnmatch
+import itertools
+import syck
+import gobject
+
+from mallet.util import atomicWrite
 
 
 class ctx:
@@ -39,6 +47,11 @@ class ctx:
     >>> from context import ctx
     >>> ctx['editor.font'] = 'Monospace'
     >>> size = int( ctx['editor.fontsize'] )
+
+    Changes can be watched; callbacks get the list of changed variables,
+    once per main loop iteration however many times they were set
+    >>> watch_id = ctx.watch('editor.*', callback)
+    >>> ctx.unwatch(watch_id)
     """
     
     main_window = property(fget=lambda self: self._get_mw())
@@ -46,6 +59,11 @@ class ctx:
     def __init__(self, app_settings_directory, get_main_window_func):
         self.app_settings_directory = app_settings_directory
         self._get_mw = get_main_window_func
+        self._cleanup_callbacks = []
+        self._watchers = {}   # watch id -> (pattern, callback)
+        self._watch_ids = itertools.count()
+        self._changed = set()
+        self._dispatch_id = None
         
         if not os.path.exists(app_settings_directory):
             os.makedirs(app_settings_directory)
@@ -53,14 +71,45 @@ class ctx:
                                         'configuration')
         if not os.path.exists(conf_file):
             open(conf_file, 'w').close()
-            
-        self._config = AppConfig(open(conf_file).read())
+
+        from mallet.config import data_dir
+        self._cache = ConfigCache(os.path.join(app_settings_directory,
+                                               'configuration.cache'),
+                                  [os.path.join(data_dir, 'default.yaml'),
+                                   conf_file])
+        data = self._cache.load()
+        if data is None:
+            self._config = AppConfig(open(conf_file).read())
+            self._cache.store(self._config._data)
+        else:
+            self._config = AppConfig(data=data)
+
+        # changes made after the last snapshot
+        self._journal = ConfigJournal(os.path.join(app_settings_directory,
+                                                   'configuration.journal'),
+                                      self._write_snapshot)
+        for var_path, value in self._journal.replay():
+            self._set(var_path, value)
         
+    def addCleanupCallback(self, callback):
+        """Call `callback()` when the application exits, before the
+        configuration is written"""
+        self._cleanup_callbacks.append(callback)
+
     def _cleanup(self):
         """Called when application is supposed to exit"""
+        for callback in self._cleanup_callbacks:
+            callback()
+        self._write_snapshot()
+
+    def _write_snapshot(self):
+        """Write the whole configuration and empty the journal"""
         # write conf file
         yaml = self._config.to_yaml()
-        open(self.conf_file, 'w').write(yaml)
+        atomicWrite(self.conf_file, [yaml])
+        # so that the next start need not parse what was just written
+        self._cache.store(self._config._data)
+        self._journal.truncate()
         
     def __getitem__(self, var_path):
         try:
@@ -68,12 +117,46 @@ class ctx:
         except NoConfigVariable:
             return self._config.create(var_path)
             
-    def __setitem__(self, var_path, value):
+    def _set(self, var_path, value):
         try:
             self._config.set(var_path, value)
         except NoConfigVariable:
             self._config.create(var_path, value)
 
+    def __setitem__(self, var_path, value):
+        self._set(var_path, value)
+        self._journal.record(var_path, value)
+        self._changed.add(var_path)
+        if self._dispatch_id is None:
+            self._dispatch_id = gobject.idle_add(self._dispatch)
+
+    def key(self, var_path):
+        """Return a compiled `ConfigKey` for var_path, creating the variable
+        if needed"""
+        self[var_path]
+        return self._config.compile(var_path)
+
+    def watch(self, pattern, callback):
+        """Call `callback(var_paths)` when variables matching the fnmatch
+        `pattern` (or their parents) change. Return id for `unwatch`"""
+        watch_id = self._watch_ids.next()
+        self._watchers[watch_id] = (pattern, callback)
+        return watch_id
+
+    def unwatch(self, watch_id):
+        del self._watchers[watch_id]
+
+    def _dispatch(self):
+        self._dispatch_id = None
+        changed, self._changed = self._changed, set()
+        for pattern, callback in self._watchers.values():
+            var_paths = [p for p in changed if fnmatch.fnmatchcase(p, pattern) 
+                         or pattern.startswith(p + '.')]
+            if var_paths:
+                var_paths.sort()
+                callback(var_paths)
+        return False
+
         
 def init_context(get_main_window_func):
     app_settings_directory = os.path.expanduser('~/.config/mallet')
@@ -87,6 +170,205 @@ class NoConfigVariable(Exception):
     """No such configuration variable is found"""
     
 
+class ConfigCache:
+
+    """Marshalled copy of the merged configuration tree
+
+    The cache is valid as long as the modification times and sizes of the
+    YAML files it was made from are unchanged.
+    """
+
+    version = 2
+
+    def __init__(self, cache_file, yaml_files):
+        self.cache_file = cache_file
+        self.yaml_files = yaml_files
+
+    def _key(self):
+        key = [self.version]
+        for filename in self.yaml_files:
+            st = os.stat(filename)
+            key.extend([st.st_mtime, st.st_size])
+        return tuple(key)
+
+    def load(self):
+        """Return the cached tree, or None if missing, stale or corrupt"""
+        try:
+            f = open(self.cache_file, 'rb')
+            try:
+                key, data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if key != self._key() or type(data) is not dict:
+            return None
+        return data
+
+    def store(self, data):
+        """Write `data` to the cache, keyed by the current state of the
+        YAML files"""
+        try:
+            atomicWrite(self.cache_file, [marshal.dumps((self._key(), data))])
+        except (IOError, OSError, ValueError):
+            # ValueError: not marshallable; YAML will be parsed next time
+            pass
+
+
+class ConfigJournal:
+
+    """Append-only log of configuration changes made since the last snapshot
+
+    Each record is a marshalled (var_path, value) preceded by its length,
+    so that a record cut short is told apart from a complete one.
+    Records are buffered, then appended and synced once no change was made
+    for `flush_delay` ms. When the journal grows beyond
+    `compact_size` bytes, `compact_callback` is called to write a full
+    snapshot, which must then `truncate` the journal.
+    """
+
+    flush_delay = 1000
+    compact_size = 65536
+
+    def __init__(self, filename, compact_callback):
+        self.filename = filename
+        self.compact_callback = compact_callback
+        self._pending = []
+        self._timer_id = None
+
+    def replay(self):
+        """Return the (var_path, value) records of the journal. A record
+        cut short by a crash (and whatever follows it) is ignored and cut
+        off, so that records appended later can be replayed"""
+        records = []
+        try:
+            f = open(self.filename, 'r+b')
+        except IOError:
+            return records
+        try:
+            good = 0 # end of the last complete record
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                length = struct.unpack('<I', header)[0]
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                try:
+                    var_path, value = marshal.loads(data)
+                except (EOFError, ValueError, TypeError):
+                    break
+                records.append((var_path, value))
+                good = f.tell()
+            if good < os.fstat(f.fileno()).st_size:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        return records
+
+    def record(self, var_path, value):
+        """Queue a change to be written"""
+        try:
+            data = marshal.dumps((var_path, value))
+        except ValueError:
+            # not marshallable; it will be in the next snapshot
+            return
+        self._pending.append(struct.pack('<I', len(data)) + data)
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+        self._timer_id = gobject.timeout_add(self.flush_delay, self._cbFlush)
+
+    def _cbFlush(self):
+        self._timer_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Append queued records to the journal, compacting if it is big"""
+        if self._pending:
+            f = open(self.filename, 'ab')
+            try:
+                f.write(''.join(self._pending))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self._pending = []
+        if os.path.exists(self.filename) and \
+           os.path.getsize(self.filename) >= self.compact_size:
+            self.compact_callback()
+
+    def truncate(self):
+        """Forget all changes; they are part of a snapshot now"""
+        self._pending = []
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+            self._timer_id = None
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+class ConfigKey:
+
+    """Compiled handle to a configuration variable
+
+    The dotted path is walked once; afterwards `get` and `set` are a single
+    dict access, until the tree is restructured (a dict is added, removed or
+    replaced) which makes every handle walk the path again.
+    """
+
+    def __init__(self, config, var_path):
+        self.config = config
+        self.var_path = var_path
+        self._vars = var_path.split('.')
+        self._name = self._vars[-1]
+        self._parent = None
+        self._generation = None
+
+    def _resolve(self):
+        if self._generation != self.config._generation:
+            obj = self.config._data
+            for var in self._vars[:-1]:
+                if type(obj) is not dict or var not in obj:
+                    raise NoConfigVariable
+                obj = obj[var]
+            if type(obj) is not dict:
+                raise NoConfigVariable
+            self._parent = obj
+            self._generation = self.config._generation
+        return self._parent
+
+    def get(self):
+        """Get value"""
+        try:
+            return self._resolve()[self._name]
+        except KeyError:
+            raise NoConfigVariable
+
+    def set(self, value):
+        """Set value"""
+        parent = self._resolve()
+        if type(value) is dict or type(parent.get(self._name)) is dict:
+            self.config._generation += 1
+        parent[self._name] = value
+
+
+def _mergeTrees(defaults, values):
+    """Return the tree of `defaults` with the variables of the tree
+    `values` set over it, section by section"""
+    merged = dict(defaults)
+    for name, value in values.items():
+        default = merged.get(name)
+        if type(default) is dict and type(value) is dict:
+            merged[name] = _mergeTrees(default, value)
+        else:
+            merged[name] = value
+    return merged
+
+
 class AppConfig:
 
     """Represent application preferences stored in a YAML file
@@ -95,39 +377,39 @@ class AppConfig:
     a/b/c, use var_path='a.b.c'
     """
     
-    def __init__(self, pref_string):
+    def __init__(self, pref_string=None, data=None):
+        """Parse `pref_string` over the defaults, or use the already merged
+        tree `data`"""
+        self._keys = {}  # var_path -> ConfigKey
+        self._generation = 0
+        if data is not None:
+            self._data = data
+            return
         # Load default values first
         from mallet.config import data_dir
         default_pref = open(os.path.join(data_dir, 'default.yaml')).read()
         default_data = syck.load(default_pref)
-        # Load from user preferences
-        self._data = syck.load(pref_string)
-        if self._data is None:
-            self._data = {}
-        self._data.update(default_data)
+        # Load from user preferences, which override the defaults
+        user_data = syck.load(pref_string)
+        if type(user_data) is not dict:
+            user_data = {}
+        self._data = _mergeTrees(default_data, user_data)
         
+    def compile(self, var_path):
+        """Return the (cached) `ConfigKey` of var_path"""
+        try:
+            return self._keys[var_path]
+        except KeyError:
+            key = self._keys[var_path] = ConfigKey(self, var_path)
+            return key
+
     def get(self, var_path):
         """Get value"""
-        obj = self._data
-        for var in var_path.split('.'):
-            try:
-                if type(obj) is not dict: raise KeyError
-                obj = obj[var]
-            except KeyError:
-                raise NoConfigVariable
-        return obj
+        return self.compile(var_path).get()
         
     def set(self, var_path, value):
         """Set value"""
-        obj = self._data
-        vars = var_path.split('.')
-        for var in vars[:-1]:
-            try:
-                if type(obj) is not dict: raise KeyError
-                obj = obj[var]
-            except KeyError:
-                raise NoConfigVariable
-        obj[vars[-1]] = value
+        self.compile(var_path).set(value)
         
     def create(self, var_path, default=''):
         """Create the variable with hierarchy
@@ -137,6 +419,7 @@ class AppConfig:
         
         Return new node's value
         """
+        self._generation += 1
         obj = self._data
         vars = var_path.split('.')
         for var in vars[:-1]:
@@ -158,4 +441,6 @@ class AppConfig:
         
     def to_yaml(self):
         """Return as yaml string"""
+        # only needed at exit
+        import ydump
         return ydump.dump(self._data)
@@ -19,140 +19,364 @@
 This could perhaps become the Editor Plugin
 """
 
+import os
 import os.path
+import re
+import codecs
+import zlib
+import threading
 
 import gobject
 import gtk
 import pango
-import gtksourceview as gsv
 
-from mallet.gtkutil import ActionControllerMixin, FileDialog, NotebookLabel
+from mallet.gtkutil import ActionControllerMixin, FileDialog, NotebookLabel, \
+     StatusMessage, ActionSensitivity, askInteger
 from mallet.context import ctx
-
-
-class UniqueNames:
-
-    """Map each filename to unique (human readable) short versions such that no
-    two filename in a 'set' has the same short version.
-    
-    eg:
-    /root/a/file.py and /root/a/open.py map to file.py and open.py
-    while
-    /root/a/file.py and /root/b/file.py map to file.py[a] and file.py[b]
-    """
-    
-    def __init__(self):
-        self.basename_map = {} # file.py -> (/root/a/file.py:shortname_changed_callback,/root/b/file.py:s_c_c)
-        self.uniquename = {}  # path -> unique
-        
-    def addPath(self, newpath, shortname_changed_callback):
-        """Add newpath to set, notifying any change in shortnames for other paths"""
-        basename = os.path.basename(newpath)
-        map_value = self.basename_map.get(basename, {})
-        map_value[newpath] = shortname_changed_callback
-        self.basename_map[basename] = map_value
-        self.uniquename[newpath] = None
-        self._updateSet(basename)
-        
-    def removePath(self, path):
-        """Remove newpath from set, notifying any change in shortnames for other paths"""
-        basename = os.path.basename[path]
-        del self.basename_map[basename][path]
-        del self.uniquename[path]
-        self._updateSet(basename)
-        
-    # main algorithm
-    def _updateSet(self, basename):
-        """Update self.basename_map[basename] set"""
-        pathmap = self.basename_map[basename]
-        shortname = {} # (basename, identity)
-                       # identify is nearest parent directory name which is unique
-        
-        parts = {} # path components
-        min_len = None
-        for path in pathmap.keys():
-            pth = os.path.dirname(path)
-            parts[path] = pth.split(os.path.sep)
-            parts[path].reverse()
-            parts[path].append('') # sentinel
-            if not min_len or min_len > len(parts[path]):
-                min_len = len(parts[path])
-            shortname[path] = [basename, '']
-        
-        # Find the common parent and use that as shortname
-        pathmap_copy = pathmap.copy()
-        for point in range(min_len):
-            if len(pathmap_copy) == 1:
-                del pathmap_copy[pathmap_copy.keys()[0]]
-                continue
-            elif len(pathmap_copy) == 0:
-                break
-            
-            part_map = {} # parts[path][point] -> path
-            for path in pathmap_copy.keys():
-                part = parts[path][point]
-                lst = part_map.get(part, [])
-                lst.append(path)
-                part_map[part] = lst
-            for part, path_lst in part_map.items():
-                if len(path_lst) == 1:
-                    # unique name found!
-                    path = path_lst[0]
-                    del pathmap_copy[path]
-                    shortname[path][1] = part
-        
-        # shortname for all paths have been found
-        assert len(pathmap_copy) == 0
-        
-        # Update and notify of modified/created shortnames
-        modified = []
-        for path, shortname in shortname.items():
-            if not self.uniquename[path] or self.uniquename[path]  != shortname:
-                shortname_changed_callback = pathmap[path]
-                self.uniquename[path] = shortname
-                shortname_changed_callback(shortname)
+from mallet.util import UniqueNames, atomicWrite, WorkerPool, splitLines, \
+     lineHunks
+from mallet.watcher import FileWatcher, fileSignature
+# the panels of the main window; the other features are imported where
+# first used, so that startup does not wait for them
+from mallet.search import FindResults
+from mallet.find import BufferSearch, MappedSearch, FindBar
+from mallet.outline import OutlineParser, OutlinePanel
 
 
 class Editor(gtk.ScrolledWindow):
 
     """High-level simple wrapper around GtkSourceView"""
 
-    LM = gsv.SourceLanguagesManager()
+    # created on first use, see `languagesManager`
+    LM = None
     
     editable = property(fget=lambda s: s.view.get_editable(), doc="Is the text editable?")
 
     def __init__(self):
+        # not needed until the first document is shown
+        import gtksourceview as gsv
         gtk.ScrolledWindow.__init__(self)
         self.buffer = gsv.SourceBuffer()
+        # the document keeps the undo history, see mallet.undo
+        self.buffer.set_max_undo_levels(0)
         self.view = gsv.SourceView(self.buffer)
         self.buffer.set_highlight(True)
         self._set_python()
         self.add_with_viewport(self.view)
         self.show()
         self.view.show()
+        # follow preference changes in place
+        watch_id = ctx.watch('editor.*', self._cbConfigChanged)
+        self.connect('destroy', lambda widget: ctx.unwatch(watch_id))
         
     def _set_python(self):
         """Set python specific settings and other defaults"""
-        language = self.LM.get_language_from_mime_type('text/x-python')
+        language = self.languagesManager().get_language_from_mime_type('text/x-python')
         self.buffer.set_language(language)
         
         self.view.set_show_line_numbers(True)
-        self.view.set_tabs_width(ctx['editor.tabs_width'])
         self.view.set_insert_spaces_instead_of_tabs(True)
         self.view.set_auto_indent(True)
         self.view.set_smart_home_end(True)
-        
+        self._apply_preferences()
+
+    def _apply_preferences(self):
+        self.view.set_tabs_width(ctx['editor.tabs_width'])
         font_desc = pango.FontDescription(ctx['editor.font_desc'])
         assert font_desc, "No monospace font available"
         self.view.modify_font(font_desc)
 
+    def _cbConfigChanged(self, var_paths):
+        self._apply_preferences()
+
+    def languagesManager(cls):
+        if cls.LM is None:
+            import gtksourceview as gsv
+            cls.LM = gsv.SourceLanguagesManager()
+        return cls.LM
+    languagesManager = classmethod(languagesManager)
+
     def setText(self, text):
         self.buffer.set_text(text)
 
+    def appendText(self, text):
+        self.buffer.insert(self.buffer.get_end_iter(), text)
+
     def getText(self):
         start, end = self.buffer.get_bounds()
         return self.buffer.get_text(start, end)
 
+    def iterText(self, chunk_size=65536):
+        """Yield the buffer text in slices of about `chunk_size` characters,
+        without ever copying the whole text"""
+        start = self.buffer.get_start_iter()
+        while not start.is_end():
+            end = start.copy()
+            end.forward_chars(chunk_size)
+            yield self.buffer.get_text(start, end)
+            start = end
+
+
+class FileLoader:
+
+    """Stream a file into an `Editor` from idle callbacks
+
+    The file is read `chunk_size` bytes at a time, decoded incrementally
+    and appended to the buffer, so the main loop keeps running while large
+    files load. Progress is shown in the main window statusbar.
+
+    @ivar lossy: True if invalid UTF-8 was replaced
+    """
+
+    def __init__(self, editor, filename, finished_callback):
+        self.editor = editor
+        self.filename = filename
+        self.finished_callback = finished_callback
+        self.chunk_size = ctx['editor.load_chunk_size']
+        self.size = os.path.getsize(filename)
+        self.nr_read = 0
+        self.file = open(filename, 'rb')
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.lossy = False
+        self.status = StatusMessage('file-loader')
+
+        buffer = editor.buffer
+        buffer.begin_not_undoable_action()
+        buffer.set_highlight(False)
+        editor.view.set_editable(False)
+        editor.setText('')
+        self._idle_id = gobject.idle_add(self._load_chunk)
+
+    def _show_progress(self):
+        percent = 100
+        if self.size:
+            percent = 100 * self.nr_read / self.size
+        self.status.set('Loading %s ... %d%%' % (self.filename, percent))
+
+    def _load_chunk(self):
+        data = self.file.read(self.chunk_size)
+        self.nr_read += len(data)
+        try:
+            text = self.decoder.decode(data, not data)
+        except UnicodeDecodeError:
+            # the decoder kept its state, go on replacing invalid bytes
+            self.lossy = True
+            self.decoder.errors = 'replace'
+            text = self.decoder.decode(data, not data)
+        if text:
+            self.editor.appendText(text)
+            # loading is not an edit
+            self.editor.buffer.set_modified(False)
+        if not data:
+            self._finish(True)
+            return False
+        self._show_progress()
+        return True
+
+    def cancel(self):
+        """Stop loading, leaving the buffer with whatever was read so far"""
+        gobject.source_remove(self._idle_id)
+        self._finish(False)
+
+    def _finish(self, completed):
+        self.file.close()
+        buffer = self.editor.buffer
+        buffer.set_highlight(True)
+        buffer.end_not_undoable_action()
+        buffer.set_modified(False)
+        self.editor.view.set_editable(not self.lossy)
+        self.status.clear()
+        self.finished_callback(completed)
+
+
+def _decodeText(data):
+    """Return the text of the UTF-8 `data` and False, or if it is not valid
+    UTF-8 the text with the invalid bytes replaced and True"""
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('utf-8', 'replace').encode('utf-8'), True
+    return data, False
+
+
+def _readFile(filename):
+    """Return the `fileSignature` of `filename` and its text, or None for
+    the text of a file to be loaded in chunks or which is not UTF-8"""
+    signature = fileSignature(filename)
+    if os.path.getsize(filename) >= ctx['editor.chunked_load_threshold']:
+        return signature, None
+    text, lossy = _decodeText(open(filename, 'rb').read())
+    if lossy:
+        # read again by openFile, which makes the document read-only
+        return signature, None
+    return signature, text
+
+
+class FileOpener:
+
+    """Open many files at once
+
+    The files are read and decoded in parallel by the editorbook I/O
+    workers. Their documents are added in order, at most `batch_size` from
+    each idle callback, so that the window keeps painting and the first
+    file can be used before the others have been read.
+    """
+
+    batch_size = 20
+
+    def __init__(self, editorbook, filenames):
+        self.editorbook = editorbook
+        self.filenames = filenames
+        self.results = [None] * len(filenames)
+        self.nr_added = 0
+        self.errors = []
+        self.status = StatusMessage('file-opener')
+        self._idle_id = None
+        pool = editorbook.ioPool()
+        for nr, filename in enumerate(filenames):
+            pool.submit(_readFile, (filename,), self._makeCallback(nr))
+
+    def _makeCallback(self, nr):
+        def read(result, error):
+            gobject.idle_add(self._read, nr, result, error)
+        return read
+
+    def _read(self, nr, result, error):
+        self.results[nr] = (result, error)
+        if self._idle_id is None and nr == self.nr_added:
+            self._idle_id = gobject.idle_add(self._addDocuments)
+        return False
+
+    def _addDocuments(self):
+        results = self.results
+        more = False
+        try:
+            for i in range(self.batch_size):
+                if self.nr_added == len(results) or \
+                   results[self.nr_added] is None:
+                    break
+                try:
+                    self._addDocument(self.nr_added, *results[self.nr_added])
+                except EnvironmentError, e:
+                    # eg: deleted since it was read
+                    self.errors.append('%s: %s' %
+                                       (self.filenames[self.nr_added], e))
+                results[self.nr_added] = True # drop the text
+                self.nr_added += 1
+            if self.nr_added == len(results):
+                self._finish()
+            elif results[self.nr_added] is not None:
+                self.status.set('Opening files ... %d of %d' %
+                                (self.nr_added, len(results)))
+                more = True
+        finally:
+            if not more:
+                # _read schedules the next batch
+                self._idle_id = None
+        return more
+
+    def _addDocument(self, nr, result, error):
+        filename = self.filenames[nr]
+        if error is not None:
+            self.errors.append('%s: %s' % (filename, error))
+            return
+        signature, text = result
+        try:
+            document = self.editorbook._createDocument(filename, lazy=True)
+        except DocumentExists, e:
+            document = e.document
+        else:
+            if text is not None:
+                document.preload(text, signature)
+            self.editorbook.addDocument(document)
+        if nr == 0:
+            self.editorbook.focusDocument(document)
+
+    def _finish(self):
+        self.status.clear()
+        if self.errors:
+            msg = gtk.MessageDialog(parent=ctx.main_window,
+                                    flags=gtk.DIALOG_MODAL,
+                                    type=gtk.MESSAGE_ERROR,
+                                    buttons=gtk.BUTTONS_OK,
+                                    message_format="Could not open:\n" +
+                                                   "\n".join(self.errors))
+            msg.run()
+            msg.destroy()
+
+
+class DocumentRegistry:
+
+    """Index of the open documents by file identity, and of the tab labels
+    of their notebook pages
+
+    A file is found by its real path or, failing that, by its (device,
+    inode) so that 'a/../b.py', symbolic links and hard links to an open
+    file all find its document.
+    """
+
+    def __init__(self):
+        self._by_path = {}    # real path -> document
+        self._by_inode = {}   # (st_dev, st_ino) -> document
+        self._keys = {}       # document -> (real path, inode or None)
+        self._labels = {}     # document -> tab label
+
+    def _fileKey(self, filename):
+        path = os.path.realpath(filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, None
+        return path, (st.st_dev, st.st_ino)
+
+    def lookup(self, filename):
+        """Return the document of `filename` or None if it is not open"""
+        path, inode = self._fileKey(filename)
+        document = self._by_path.get(path)
+        if document is None and inode is not None:
+            document = self._by_inode.get(inode)
+            # saving replaces the file, so the inode may have been reused
+            if document is not None and \
+               self._fileKey(document.filename)[1] != inode:
+                document = None
+        return document
+
+    def add(self, document):
+        """Index `document` by its (current) filename"""
+        path, inode = key = self._fileKey(document.filename)
+        self._keys[document] = key
+        self._by_path[path] = document
+        if inode is not None:
+            self._by_inode[inode] = document
+
+    def remove(self, document):
+        path, inode = self._keys.pop(document)
+        if self._by_path.get(path) is document:
+            del self._by_path[path]
+        if inode is not None and self._by_inode.get(inode) is document:
+            del self._by_inode[inode]
+
+    def update(self, document):
+        """Re-index `document` after it was renamed or its file replaced"""
+        if document in self._keys:
+            self.remove(document)
+        self.add(document)
+
+    # notebook pages
+
+    def appendPage(self, document, label):
+        self._labels[document] = label
+
+    def removePage(self, document):
+        del self._labels[document]
+
+    def hasPage(self, document):
+        """Is `document` shown in the notebook?"""
+        return document in self._labels
+
+    def label(self, document):
+        return self._labels[document]
+
 
 class Document(gobject.GObject):
 
@@ -161,40 +385,205 @@ class Document(gobject.GObject):
 
     @ivar filename: The file represented by the document
     @ivar shortname: Unique name (shorted than filename) for this document
-    @ivar editor: The editor widget contained in document
+    @ivar editor: The editor widget contained in document, None until the
+                  document is materialized
+    @ivar page: The notebook page widget, holding the editor
+    @ivar disk_signature: `fileSignature` of the file when it was last
+                          read or written
+    @ivar swap: The `SwapFile` logging the unsaved edits, or None
+    @ivar undo: The `UndoStack`
+    @ivar lossy: True if the file is not valid UTF-8. The invalid bytes
+                 are shown replaced and the document is read-only, as
+                 saving would not write them back
     """
 
-    # Created (named) documents 'hashed' by the filename
-    live_documents = {}
+    # Created (named) documents and the notebook pages
+    registry = DocumentRegistry()
+
+    # Estimated bytes used by each buffer line besides its text (line and
+    # segment structures, highlighting tags, ...)
+    line_overhead = 100
     
     clipboard = gtk.Clipboard()
     
     uniquename = UniqueNames()
     editorbook = None
+    watcher = None
 
     __gsignals__ = {
-        'shortname-changed': (gobject.SIGNAL_RUN_LAST, None, (str,))
+        'shortname-changed': (gobject.SIGNAL_RUN_LAST, None, (str,)),
+        'load-finished': (gobject.SIGNAL_RUN_LAST, None, (bool,)),
+        'modified-changed': (gobject.SIGNAL_RUN_LAST, None, (bool,)),
+        'outline-changed': (gobject.SIGNAL_RUN_LAST, None, ()),
     }
 
     filename = property(fget=lambda self: self.__filename)
     shortname = property(fget=lambda self: self.__shortname)
+    loading = property(fget=lambda self: self._loader is not None,
+                       doc="Is the file still being streamed in?")
+    materialized = property(fget=lambda self: self.editor is not None,
+                            doc="Has the editor been created?")
 
-    def __init__(self, filename=None):
-        if filename and filename in self.live_documents:
-            raise DocumentExists, self.live_documents[filename]
+    def __init__(self, filename=None, lazy=False):
+        """If `lazy`, neither the editor is created nor the file is read
+        until `materialize` is called"""
+        if filename:
+            existing = self.registry.lookup(filename)
+            if existing is not None:
+                raise DocumentExists, existing
         self.__filename = None
         self.__shortname = None
+        self._loader = None
+        self._edit_serial = 0
+        self._pending_line = None
+        self._reload_pending = False
+        self._snapshot = None
+        self._snapshot_modified = False
+        self._prefetched = None
+        self._search = None
+        self.outline = [] # see mallet.outline
+        self._outline_timer = None
+        self._outline_serial = 0
+        self.saving = False
+        self.lossy = False
+        # saves are numbered and written one at a time, so that a pending
+        # background save never replaces the file of a later save
+        self._save_lock = threading.Lock()
+        self._save_generation = 0
+        self.disk_signature = None
+        self.swap = None
+        self._swap_muted = False
+        from mallet.undo import UndoStack
+        self.undo = UndoStack(ctx['editor.undo_budget'])
+        self._undo_muted = False
+        self.editor = None
         gobject.GObject.__init__(self)
-        self.editor = Editor()
-        
+        self.page = gtk.VBox()
+        self.page.set_data('document-instance', self)
+        self.page.show()
+
+        if lazy and filename:
+            self._set_filename(filename)
+        else:
+            self._buildEditor()
+            if filename:
+                self.openFile(filename)
         if filename:
-            self.openFile(filename)
-            Document.live_documents[filename] = self
+            self.registry.add(self)
+
+    def _createEditor(self):
+        return Editor()
+
+    def _buildEditor(self):
+        self.editor = self._createEditor()
+        self.editor.buffer.connect('changed', self._cbBufferChanged)
+        self.editor.buffer.connect('insert-text', self._cbInsertText)
+        self.editor.buffer.connect('delete-range', self._cbDeleteRange)
+        self.editor.buffer.connect('begin-user-action',
+                                   self._cbBeginUserAction)
+        self.editor.buffer.connect('end-user-action', self._cbEndUserAction)
+        self.editor.buffer.connect_after('modified-changed',
+                                         self._cbModifiedChanged)
         self.editor.show()
-        self.editor.set_data('document-instance', self)
-        
-        
-    def __set_filename(self, value):
+        self.page.pack_start(self.editor)
+
+    def _destroyEditor(self):
+        self.endSearch()
+        self.page.remove(self.editor)
+        self.editor.destroy()
+        self.editor = None
+
+    def materialize(self):
+        """Create the editor and read the file of a lazy or hibernated
+        document"""
+        if self.editor is not None:
+            return
+        self._buildEditor()
+        if self._snapshot is not None:
+            buffer = self.editor.buffer
+            buffer.begin_not_undoable_action()
+            self._swap_muted = self._undo_muted = True
+            try:
+                self.editor.setText(zlib.decompress(self._snapshot))
+            finally:
+                self._swap_muted = self._undo_muted = False
+                buffer.end_not_undoable_action()
+            buffer.set_modified(self._snapshot_modified)
+            self._snapshot = None
+        elif self._prefetched is not None:
+            text, signature = self._prefetched
+            self._prefetched = None
+            current = fileSignature(self.filename)
+            if signature == current:
+                self.openFile(self.filename, text, signature)
+            elif current is None:
+                self._openDeleted(text)
+            else:
+                self.openFile(self.filename)
+        elif fileSignature(self.filename) is None:
+            self._openDeleted('')
+        else:
+            self.openFile(self.filename)
+        if not self.loading:
+            self._restore_cursor()
+
+    def _openDeleted(self, text):
+        """Show `text` for a file deleted on disk before it was read into
+        the editor, as modified: saving puts the file back"""
+        self.disk_signature = None
+        buffer = self.editor.buffer
+        buffer.begin_not_undoable_action()
+        self._swap_muted = self._undo_muted = True
+        try:
+            self.editor.setText(text)
+        finally:
+            self._swap_muted = self._undo_muted = False
+            buffer.end_not_undoable_action()
+        buffer.set_modified(True)
+        self._rebaseSwap()
+
+    def hibernate(self):
+        """Drop the editor to free memory, keeping only the filename (or a
+        compressed copy of the text if it is modified or unnamed); the file
+        is read again by `materialize`, which keeps the undo history only
+        if the file did not change meanwhile. Return False if the document
+        cannot hibernate now"""
+        if self.editor is None or self.loading or self.saving:
+            return False
+        self._pending_line = self.getCursorLine()
+        if self.getModified() or self.filename is None:
+            self._snapshot = zlib.compress(self.editor.getText())
+            self._snapshot_modified = self.getModified()
+        self._destroyEditor()
+        return True
+
+    def memoryUsage(self):
+        """Return an estimate of the bytes held by this document: the
+        characters of the buffer and `line_overhead` per line, as what GTK
+        allocates is not measured"""
+        if self.editor is None:
+            if self._prefetched is not None:
+                return len(self._prefetched[0])
+            return len(self._snapshot or '')
+        buffer = self.editor.buffer
+        return (buffer.get_char_count() + 
+                buffer.get_line_count() * self.line_overhead)
+
+    def getText(self):
+        """Return the whole text, even of a hibernated document"""
+        if self.editor is None:
+            return zlib.decompress(self._snapshot)
+        return self.editor.getText()
+
+    def setModified(self, modified):
+        if self.editor is None:
+            self._snapshot_modified = modified
+            self._swapModifiedChanged(modified)
+            self.emit('modified-changed', modified)
+        else:
+            self.editor.buffer.set_modified(modified)
+
+    def _set_filename(self, value):
         def update_shortname(shortname):
             if shortname[1]:
                 sname = '%s [%s]' % (shortname[0], shortname[1])
@@ -208,88 +597,472 @@ class Document(gobject.GObject):
         self.__filename = value
         if oldfilename:
             self.uniquename.removePath(oldfilename)
+            if self.watcher:
+                self.watcher.unwatch(oldfilename)
         self.uniquename.addPath(value, update_shortname)
+        if self.watcher:
+            self.watcher.watch(value)
 
     def close(self):
         """Destroy this document"""
+        self.cancelLoad()
+        if self._outline_timer is not None:
+            gobject.source_remove(self._outline_timer)
+            self._outline_timer = None
+        # drop the answer of a pending request
+        self._outline_serial += 1
+        self._discardSwap()
+        self.keepHistory(self.editorbook.ioPool())
         if self.filename:
-            del Document.live_documents[self.filename]
+            self.registry.remove(self)
+            # lets the other files drop the disambiguating directories
+            self.uniquename.removePath(self.filename)
+            if self.watcher:
+                self.watcher.unwatch(self.filename)
+        self.page.destroy()
 
-    def openFile(self, filename):
-        """Open file"""
-        self.editor.buffer.begin_not_undoable_action()
+    def openFile(self, filename, text=None, signature=None):
+        """Open file. The `text` of the file and its `fileSignature` may be
+        passed if it was read already (see `preload`)
+        
+        Files of 'editor.chunked_load_threshold' bytes or more are streamed
+        in from idle callbacks; 'load-finished' is emitted when done.
+        """
+        if text is None:
+            signature = fileSignature(filename)
+        if signature != self.disk_signature or filename != self.filename:
+            # another text, not the same one materialized again
+            from mallet.undo import UndoStack
+            self.undo = UndoStack(ctx['editor.undo_budget'])
+        self.disk_signature = signature
+        if text is None and \
+           os.path.getsize(filename) >= ctx['editor.chunked_load_threshold']:
+            self._loader = FileLoader(self.editor, filename, self._load_finished)
+        else:
+            lossy = False
+            if text is None:
+                text, lossy = _decodeText(open(filename, 'rb').read())
+            self._setLossy(lossy, filename)
+            self.editor.buffer.begin_not_undoable_action()
+            self._swap_muted = self._undo_muted = True
+            try:
+                self.editor.setText(text)
+            finally:
+                self._swap_muted = self._undo_muted = False
+                self.editor.buffer.end_not_undoable_action()
+            self.editor.buffer.set_modified(False)
+        self._set_filename(filename)
+        if not self.loading:
+            self._loadHistory(text)
+
+    def _setLossy(self, lossy, filename):
+        self.lossy = lossy
+        self.editor.view.set_editable(not lossy)
+        if lossy:
+            StatusMessage('decode').set('%s is not valid UTF-8, opened '
+                                        'read-only' % filename)
+
+    def preload(self, text, signature):
+        """Keep the `text` read from the file (when its `fileSignature` was
+        `signature`) for a lazy document to show without reading it again"""
+        self._prefetched = (text, signature)
+
+    def reload(self):
+        """Make the text that of the file again, discarding any changes
+
+        The file is read and diffed against the text by a worker thread and
+        only the lines which differ are replaced, as one undoable action;
+        the cursor, scroll position and highlighting elsewhere are kept.
+        """
+        if self.editor is None:
+            # materialize reads the file
+            self._snapshot = None
+            self.setModified(False)
+            return
+        if self.loading:
+            self._reload_pending = True
+            return
+        serial = self._edit_serial
+        modified = self.getModified()
+        text = self.editor.getText()
+        def diffed(result, error):
+            gobject.idle_add(self._apply_reload, serial, modified, result,
+                             error)
+        self.editorbook.ioPool().submit(_diffFile, (text, self.filename),
+                                        diffed)
+
+    def _apply_reload(self, serial, modified, result, error):
+        if self.editor is None:
+            return False # hibernated meanwhile, materialize reads the file
+        if error is not None:
+            StatusMessage('reload').set('Could not reload %s: %s' %
+                                        (self.filename, error))
+            return False
+        if serial != self._edit_serial:
+            if not modified and self.getModified():
+                # the silent reload was for an unmodified text; ask rather
+                # than throw away what was typed meanwhile
+                self.editorbook.resolveDiskChange(self.filename, result[0])
+            else:
+                # edited meanwhile, diff against the new text
+                self.reload()
+            return False
+        signature, edits = result
+        buffer = self.editor.buffer
+        buffer.begin_user_action()
+        self._swap_muted = True
         try:
-            self.editor.setText(open(filename).read())
+            for start, end, text in edits:
+                start_iter = buffer.get_iter_at_offset(start)
+                buffer.delete(start_iter, buffer.get_iter_at_offset(end))
+                buffer.insert(start_iter, text)
         finally:
-            self.editor.buffer.end_not_undoable_action()
-        self.editor.buffer.set_modified(False)
-        self.__set_filename(filename)
+            self._swap_muted = False
+            buffer.end_user_action()
+        self._discardSwap()
+        self.disk_signature = signature
+        self.undo.markSaved()
+        buffer.set_modified(False)
+        return False
+
+    def cancelLoad(self):
+        """Stop streaming the file in"""
+        if self._loader:
+            self._loader.cancel()
+
+    def _load_finished(self, completed):
+        self._setLossy(self._loader.lossy, self.filename)
+        self._loader = None
+        if completed:
+            self._restore_cursor()
+            self._loadHistory(self.editor.getText())
+            if self._reload_pending:
+                self._reload_pending = False
+                self.reload()
+        self.emit('load-finished', completed)
 
     def save(self, newFilenameIfAny=None):
         """Save to file. Use `newFilenameIfAny` (if passed) and update 
         the document filename accordingly"""
-        text = self.editor.getText()
         if newFilenameIfAny:
             filename = newFilenameIfAny
         else:
             filename = self.filename
         if filename is None:
             raise DocumentHasNoFilename
-        open(filename, 'w').write(text)
-        self.editor.buffer.set_modified(False)
-        self.__set_filename(filename)
+        if self.lossy:
+            raise DocumentReadOnly, 'not valid UTF-8, opened read-only'
+        self._save_lock.acquire()
+        try:
+            self._save_generation += 1
+            if self.editor is None:
+                atomicWrite(filename, [self.getText()])
+            else:
+                atomicWrite(filename, self.editor.iterText())
+        finally:
+            self._save_lock.release()
+        self.disk_signature = fileSignature(filename)
+        self.undo.markSaved()
+        self.setModified(False)
+        self._set_filename(filename)
+        self.registry.update(self)
+
+    def saveInBackground(self, pool, finished_callback):
+        """Snapshot the text and let a thread of `pool` write it out.
+        `finished_callback(document, error)` is called in the main loop;
+        the buffer is marked unmodified only if it was not edited meanwhile"""
+        if self.filename is None:
+            raise DocumentHasNoFilename
+        if self.lossy:
+            raise DocumentReadOnly, 'not valid UTF-8, opened read-only'
+        self.saving = True
+        serial = self._edit_serial
+        self._save_generation += 1
+        generation = self._save_generation
+        text = self.getText()
+        def written(result, error):
+            gobject.idle_add(self._background_save_done, serial, generation,
+                             error, finished_callback)
+        pool.submit(self._write, (self.filename, text, generation), written)
+
+    def _write(self, filename, text, generation):
+        """Write `text` unless a later save started. Run by a worker"""
+        self._save_lock.acquire()
+        try:
+            if generation == self._save_generation:
+                atomicWrite(filename, [text])
+        finally:
+            self._save_lock.release()
+
+    def _background_save_done(self, serial, generation, error,
+                              finished_callback):
+        self.saving = False
+        if generation != self._save_generation:
+            # superseded: the later save keeps the file and buffer state
+            finished_callback(self, error)
+            return False
+        if error is None:
+            # the file was replaced by a new one
+            self.disk_signature = fileSignature(self.filename)
+            self.registry.update(self)
+        if error is None and serial == self._edit_serial:
+            self.undo.markSaved()
+            self.setModified(False)
+        elif error is None:
+            # edited while saving: the swap no longer applies to the file
+            self._rebaseSwap()
+        finished_callback(self, error)
+        return False
+
+    def _cbBufferChanged(self, buffer):
+        self._edit_serial += 1
+        self._scheduleOutline()
+
+    def isPython(self):
+        return self.filename is None or \
+               self.filename.endswith(('.py', '.pyw'))
+
+    def _scheduleOutline(self):
+        """Update the outline once the text has not changed for
+        'editor.outline_delay' milliseconds"""
+        if not self.isPython():
+            return
+        if self._outline_timer is not None:
+            gobject.source_remove(self._outline_timer)
+        self._outline_timer = gobject.timeout_add(ctx['editor.outline_delay'],
+                                                  self._cbOutlineTimer)
+
+    def _cbOutlineTimer(self):
+        self._outline_timer = None
+        if self.editor is None:
+            return False
+        self._outline_serial += 1
+        serial = self._outline_serial
+        def parsed(outline):
+            # a later request may have been answered already
+            if serial == self._outline_serial:
+                self.outline = outline
+                self.emit('outline-changed')
+        OutlineParser.request(self.getText(), parsed)
+        return False
+
+    def _cbModifiedChanged(self, buffer):
+        modified = self.getModified()
+        self._swapModifiedChanged(modified)
+        self.emit('modified-changed', modified)
+
+    def recover(self, text):
+        """Replace the text with `text` recovered from a swap file"""
+        if self.editor is None:
+            self._snapshot = zlib.compress(text)
+            self.disk_signature = fileSignature(self.filename)
+            from mallet.swap import SwapFile
+            self.swap = SwapFile(self.filename, None)
+            self.swap.snapshot(text)
+        else:
+            # logged to the swap file like any other edit
+            self.editor.buffer.begin_user_action()
+            self.editor.setText(text)
+            self.editor.buffer.end_user_action()
+        self.setModified(True)
+
+    def keepHistory(self, pool=None):
+        """Store the undo history (by a thread of `pool`, if given) for the
+        next time the file is opened with the same text"""
+        if not ctx['editor.undo_persist'] or self.filename is None or \
+           self.getModified() or not (self.undo.canUndo() or
+                                      self.undo.canRedo()):
+            return
+        from mallet.undo import storeHistory
+        args = (self.filename, self.disk_signature, self.undo.dump())
+        if pool is None:
+            storeHistory(*args)
+        else:
+            pool.submit(storeHistory, args)
+
+    def _loadHistory(self, text):
+        if not ctx['editor.undo_persist'] or self.undo.canUndo() or \
+           self.undo.canRedo():
+            return
+        from mallet.undo import loadHistory
+        serial = self._edit_serial
+        def loaded(data, error):
+            if data is not None:
+                gobject.idle_add(self._history_loaded, serial, data)
+        self.editorbook.ioPool().submit(loadHistory, (self.filename, text),
+                                        loaded)
+
+    def _history_loaded(self, serial, data):
+        # unless edited meanwhile
+        if serial == self._edit_serial:
+            from mallet.undo import UndoStack
+            self.undo = UndoStack.load(data, ctx['editor.undo_budget'])
+            self.editorbook.action_states.invalidate()
+        return False
+
+    def keepChanges(self, signature):
+        """Keep the text although the file changed on disk (to
+        `signature`)"""
+        self.disk_signature = signature
+        if self.swap is not None:
+            self._rebaseSwap()
+
+    # Swap file. Edits are queued by the buffer signal handlers and
+    # written out by the editorbook's autosave timer
+
+    def _cbInsertText(self, buffer, iter, text, length):
+        if self.loading:
+            return
+        offset = iter.get_offset()
+        if not self._swap_muted:
+            self._swapFile().inserted(offset, text)
+        if not self._undo_muted:
+            self.undo.inserted(offset, text)
+
+    def _cbDeleteRange(self, buffer, start, end):
+        if self.loading:
+            return
+        if not self._swap_muted:
+            self._swapFile().deleted(start.get_offset(), end.get_offset())
+        if not self._undo_muted:
+            self.undo.deleted(start.get_offset(), buffer.get_text(start, end))
+
+    def _cbBeginUserAction(self, buffer):
+        if not self._undo_muted:
+            self.undo.beginGroup()
+
+    def _cbEndUserAction(self, buffer):
+        if not self._undo_muted:
+            self.undo.endGroup()
+
+    def _swapFile(self):
+        if self.swap is None:
+            from mallet.swap import SwapFile
+            self.swap = SwapFile(self.filename, self.disk_signature)
+        return self.swap
+
+    def _swapModifiedChanged(self, modified):
+        if not modified:
+            self._discardSwap()
+
+    def _discardSwap(self):
+        if self.swap is not None:
+            self.editorbook.ioPool().submit(self.swap.discard)
+            self.swap = None
+
+    def _rebaseSwap(self):
+        """Start a new swap file holding the whole text, for when the file
+        it was based on changed"""
+        self._discardSwap()
+        from mallet.swap import SwapFile
+        self.swap = SwapFile(self.filename, None)
+        self.swap.snapshot(self.getText())
 
     def getModified(self):
         """Return True if the buffer was modified since last saved"""
+        if self.editor is None:
+            return self._snapshot_modified
         return self.editor.buffer.get_modified()
+
+    def getCursorLine(self):
+        """Return the line of the cursor (counted from 0)"""
+        if self.editor is None or self.loading:
+            return self._pending_line or 0
+        buffer = self.editor.buffer
+        return buffer.get_iter_at_mark(buffer.get_insert()).get_line()
+
+    def setCursorLine(self, line):
+        """Like `gotoLine`, but deferred until the document is materialized
+        and loaded"""
+        self._pending_line = line
+        if self.editor is not None and not self.loading:
+            self._restore_cursor()
+
+    def _restore_cursor(self):
+        if self._pending_line is not None:
+            self.gotoLine(self._pending_line)
+            self._pending_line = None
+
+    def getLineCount(self):
+        return self.editor.buffer.get_line_count()
+
+    def gotoLine(self, line):
+        """Move the cursor to `line` (counted from 0) and scroll to it"""
+        buffer = self.editor.buffer
+        buffer.place_cursor(buffer.get_iter_at_line(line))
+        self.editor.view.scroll_to_mark(buffer.get_insert(), 0.25)
+
+    def wordAtCursor(self):
+        """Return the identifier under the cursor, or None"""
+        buffer = self.editor.buffer
+        cursor = buffer.get_iter_at_mark(buffer.get_insert())
+        start = cursor.copy()
+        start.set_line_offset(0)
+        end = cursor.copy()
+        if not end.ends_line():
+            end.forward_to_line_end()
+        text = buffer.get_text(start, end).decode('utf-8')
+        column = cursor.get_line_offset()
+        for match in re.finditer(r'\w+', text, re.U):
+            if match.start() <= column <= match.end():
+                return match.group().encode('utf-8')
+        return None
+
+    def _createSearch(self):
+        return BufferSearch(self.editor)
+
+    def search(self, text, count_callback=None, found_callback=None):
+        """Select the first match of `text` as typed in the find bar (see
+        `BufferSearch.setQuery`). Return False if not found, or None if
+        `found_callback(found)` is to be called later"""
+        if self._search is None:
+            self._search = self._createSearch()
+        return self._search.setQuery(text, count_callback, found_callback)
+
+    def searchNext(self, backward=False):
+        """Select the next (or previous) match of the search; return as
+        `search` does"""
+        if self._search is None:
+            return False
+        return self._search.findNext(backward)
+
+    def endSearch(self):
+        if self._search is not None:
+            self._search.close()
+            self._search = None
         
     # The selected and deselected methods will be called when the document
     # is selected or deselected in the editor notebook accordingly
         
+    # Buffer signals after which the action states may have changed
+    state_signals = ('changed', 'modified-changed', 'mark-set')
+
+    def actionStates(self):
+        """Return {action_name: sensitive} for the page actions which
+        depend on this document"""
+        buffer = self.editor.buffer
+        selection = buffer.get_selection_bounds() != ()
+        return {'Cut': selection,
+                'Copy': selection,
+                'Save': self.getModified(),
+                'Undo': self.undo.canUndo(),
+                'Redo': self.undo.canRedo(),
+                'Stop': self.loading}
+
     def selected(self):
-        states = {}
-        
-        if not self.editor.buffer.get_selection_bounds():
-            states['Cut'] = states['Copy'] = False
-        else:
-            states['Cut'] = states['Copy'] = True
-            
-        if self.getModified():
-            states['Save'] = True
-        else:
-            states['Save'] = False
-            
-        states['Undo'] = self.editor.buffer.can_undo()
-        states['Redo'] = self.editor.buffer.can_redo()
-        
-        for action_name, sensitive in states.items():
-            action = self.editorbook.action_group.get_action(action_name)
-            action.set_sensitive(sensitive)
-            
-        def undo_redo_changed(buffer, can_do, action_name):
-            action = self.editorbook.action_group.get_action(action_name)
-            action.set_sensitive(can_do)
-            
-        def modified_changed(buffer, action_name):
-            action = self.editorbook.action_group.get_action(action_name)
-            action.set_sensitive(self.getModified())
-            
-        def mark_set(buffer, iter, mark):
-            sensitive = not self.editor.buffer.get_selection_bounds() == ()
-            for action_name in ('Cut', 'Copy'):
-                action = self.editorbook.action_group.get_action(action_name)
-                action.set_sensitive(sensitive)
-            
-        id1 = self.editor.buffer.connect('can-redo', undo_redo_changed, 'Redo')
-        id2 = self.editor.buffer.connect('can-undo', undo_redo_changed, 'Undo')
-        id3 = self.editor.buffer.connect_after('modified-changed', modified_changed, 'Save')
-        id4 = self.editor.buffer.connect('mark-set', mark_set)
-        
-        self._selected_handlers = [id1, id2, id3, id4]
+        invalidate = self.editorbook.action_states.invalidate
+        def changed(*args):
+            invalidate()
+        buffer = self.editor.buffer
+        self._selected_handlers = [(buffer, buffer.connect(signal, changed))
+                                   for signal in self.state_signals]
+        self._selected_handlers.append((self, self.connect('load-finished',
+                                                           changed)))
+        invalidate()
         
     def deselected(self):
-        for handler_id in self._selected_handlers:
-            self.editor.buffer.disconnect(handler_id)
+        for obj, handler_id in self._selected_handlers:
+            obj.disconnect(handler_id)
         
     # Action callbacks
     def on_Cut(self, widget):
@@ -301,15 +1074,156 @@ class Document(gobject.GObject):
     def on_Paste(self, widget):
         self.editor.buffer.paste_clipboard(self.clipboard, None, self.editor.view.get_editable())
 
+    # sensitivity is updated lazily, the actions may fire with nothing
+    # left to undo or redo
+
     def on_Undo(self, widget):
-        self.editor.buffer.undo()
+        if self.undo.canUndo():
+            self._replay(self.undo.undo(), True)
         
     def on_Redo(self, widget):
-        self.editor.buffer.redo()
+        if self.undo.canRedo():
+            self._replay(self.undo.redo(), False)
+
+    def _replay(self, records, revert):
+        """Apply edit `records`, or their inverse if `revert`"""
+        buffer = self.editor.buffer
+        self._undo_muted = True
+        buffer.begin_user_action()
+        try:
+            for kind, offset, text in records:
+                start = buffer.get_iter_at_offset(offset)
+                if (kind == 'i') == revert:
+                    end = buffer.get_iter_at_offset(
+                        offset + len(text.decode('utf-8')))
+                    buffer.delete(start, end)
+                else:
+                    buffer.insert(start, text)
+                buffer.place_cursor(start)
+        finally:
+            buffer.end_user_action()
+            self._undo_muted = False
+        self.editor.view.scroll_to_mark(buffer.get_insert(), 0.25)
+        if self.undo.atSaved():
+            buffer.set_modified(False)
+
+    def on_Stop(self, widget):
+        self.cancelLoad()
     
 
 gobject.type_register(Document)
 
+
+def _diffFile(text, filename):
+    """Return the `fileSignature` of `filename` and the (start, end, text)
+    edits, last first, which turn `text` into its content. Offsets count
+    characters, as TextBuffer iterators do"""
+    signature = fileSignature(filename)
+    old = splitLines(text.decode('utf-8'))
+    new = splitLines(open(filename).read().decode('utf-8'))
+    offsets = [0]
+    for line in old:
+        offsets.append(offsets[-1] + len(line))
+    return signature, [(offsets[i1], offsets[i2],
+                        ''.join(new[j1:j2]).encode('utf-8'))
+                       for i1, i2, j1, j2 in reversed(lineHunks(old, new))]
+
+
+class LargeFileDocument(Document):
+
+    """Read-only document for files of 'editor.large_file_threshold' bytes
+    or more. The file is memory mapped by a `LargeFileViewer` instead of
+    being copied into a SourceBuffer"""
+
+    def _createEditor(self):
+        from mallet.viewer import LargeFileViewer
+        return LargeFileViewer()
+
+    def openFile(self, filename):
+        self.disk_signature = fileSignature(filename)
+        self.editor.openFile(filename)
+        self._set_filename(filename)
+
+    def _destroyEditor(self):
+        self.editor.close()
+        Document._destroyEditor(self)
+
+    def reload(self):
+        if self.editor is None:
+            return
+        line = self.getCursorLine()
+        self.editor.close()
+        self.openFile(self.filename)
+        self.gotoLine(line)
+
+    def close(self):
+        if self.editor is not None:
+            self.editor.close()
+        Document.close(self)
+
+    def memoryUsage(self):
+        if self.editor is None:
+            return 0
+        return self.editor.memoryUsage()
+
+    def save(self, newFilenameIfAny=None):
+        raise DocumentReadOnly
+
+    def getModified(self):
+        return False
+
+    def getLineCount(self):
+        return self.editor.getLineCount()
+
+    def getCursorLine(self):
+        if self.editor is None:
+            return self._pending_line or 0
+        return self.editor.cursorLine()
+
+    def gotoLine(self, line):
+        self.editor.gotoLine(line)
+
+    def find(self, text):
+        """Select the next occurrence of `text`, return False if not found"""
+        return self.editor.find(text) is not None
+
+    def isPython(self):
+        # the viewer's buffer only holds the visible lines
+        return False
+
+    def _createSearch(self):
+        # the viewer has no buffer to search, the mapped file is scanned
+        return MappedSearch(self.editor)
+
+    state_signals = ('mark-set',)
+
+    def actionStates(self):
+        selection = self.editor.buffer.get_selection_bounds() != ()
+        return {'Cut': False, 'Copy': selection, 'Paste': False, 
+                'Undo': False, 'Redo': False, 'Save': False, 'Stop': False}
+
+    def on_Cut(self, widget):
+        pass
+
+    def on_Paste(self, widget):
+        pass
+
+    def on_Undo(self, widget):
+        pass
+
+    def on_Redo(self, widget):
+        pass
+
+    # the buffer only holds the visible lines, and they cannot be edited
+    def _cbInsertText(self, buffer, iter, text, length):
+        pass
+
+    def _cbDeleteRange(self, buffer, start, end):
+        pass
+
+
+gobject.type_register(LargeFileDocument)
+
     
 class EditorBook(gtk.Notebook, ActionControllerMixin):
 
@@ -325,10 +1239,20 @@ class EditorBook(gtk.Notebook, ActionControllerMixin):
              'Open new file'),
             ('Open', gtk.STOCK_OPEN, '_Open ...', '<Control>o',
              'Open existing file'),
+            ('QuickOpen', None, '_Quick Open ...', '<Control><Shift>o',
+             'Open a project file by (part of) its name'),
+            ('FindInFiles', gtk.STOCK_FIND, 'Find in _Files ...',
+             '<Control><Shift>f', 'Search the project files'),
+            ('ProjectRoot', gtk.STOCK_DIRECTORY, 'Project _Root ...', None,
+             'Select the directory of the project files'),
             ('Save', gtk.STOCK_SAVE, '_Save', '<Control>s',
              'Save current file'),
+            ('SaveAll', gtk.STOCK_SAVE, 'Save A_ll', '<Control><Shift>s',
+             'Save all modified files'),
             ('Close', gtk.STOCK_CLOSE, '_Close', None,
              'Close current file'),
+            ('Stop', gtk.STOCK_STOP, 'S_top Loading', None,
+             'Stop loading current file'),
 
             ('Undo', gtk.STOCK_UNDO, '_Undo', '<Control>z',
              'Undo last change'),
@@ -340,31 +1264,71 @@ class EditorBook(gtk.Notebook, ActionControllerMixin):
              'Copy selected text to clipboard'),
             ('Paste', gtk.STOCK_PASTE, '_Paste', '<Control>p',
              'Paste text from clipboard'),
+            ('GotoLine', gtk.STOCK_JUMP_TO, '_Go to Line ...', '<Control>l',
+             'Move cursor to a given line'),
+            ('GotoSymbol', gtk.STOCK_JUMP_TO, 'Go to _Symbol ...',
+             '<Control>r', 'Move cursor to a class or function'),
+            ('GotoDefinition', None, 'Go to _Definition', 'F12',
+             'Move cursor to the definition of the name under it'),
+            ('FindUsages', None, 'Find _Usages', '<Shift>F12',
+             'List the project lines using the name under the cursor'),
+            ('Find', gtk.STOCK_FIND, '_Find ...', '<Control>f',
+             'Search the current file as you type'),
+            ('FindNext', None, 'Find Ne_xt', '<Control>g',
+             'Find the next match'),
+            ('FindPrevious', None, 'Find Pre_vious', '<Control><Shift>g',
+             'Find the previous match'),
+            ])
+        ag.add_toggle_actions([
+            ('ShowOutline', None, '_Outline', 'F8',
+             'Show the classes and functions of the current file'),
             ])
             
         self.page_actions = ['Undo', 'Redo', 'Cut', 'Copy', 'Paste',
-                        'Save', 'Close']
-        # create Page action callbacks
+                        'Save', 'SaveAll', 'Close', 'Stop', 'GotoLine',
+                        'Find', 'FindNext', 'FindPrevious', 'GotoSymbol',
+                        'GotoDefinition', 'FindUsages']
+        self.action_states = ActionSensitivity(ag, self._computeActionStates)
+
+        # Page actions are dispatched to the focused document, unless
+        # 'self' defines the callback
+        own_actions = dict(self.actionCallbacks())
         for action_name in self.page_actions:
-            action = self.action_group.get_action(action_name)
-            def getActionCB(action_name):
-                """Return function that calls the Action callback on
-                the focused document
-                """
-                def dispatchAction(widget):
-                    doc = self.currentDocument()
-                    cb = getattr(doc, 'on_%s'%action_name)
-                    return cb(widget)
-                return dispatchAction
-            # connect only if 'self' didnt define the callback
-            if not hasattr(self, 'on_%s'%action_name):
-                action.connect('activate', getActionCB(action_name))
+            if action_name not in own_actions:
+                action = self.action_group.get_action(action_name)
+                action.connect('activate', self._dispatchPageAction,
+                               'on_%s' % action_name)
 
+        self._io_pool = None
+        self._project = None
+        self._xref = None
+        self._current = None
+        self._recent = [] # documents, most recently selected first
+        self._budget_idle_id = None
+        self._disk_changes = {}
+        self._resolving_changes = False
+        # documents whose file was deleted on disk, until saved or closed
+        self._deleted = []
+        self._deleted_status = StatusMessage('file-watcher')
+        self.find_results = FindResults(self)
+        self.find_bar = FindBar(self)
+        self.outline_panel = OutlinePanel(self)
+        Document.watcher = self.watcher = FileWatcher(
+            self._cbFilesChanged, ctx['editor.watch_interval'] / 1000.0)
+        ctx.addCleanupCallback(self.watcher.stop)
+        ctx.addCleanupCallback(self.saveSession)
+        ctx.addCleanupCallback(self._flushSwapFiles)
+        ctx.addCleanupCallback(self._keepHistories)
+        gobject.timeout_add(ctx['editor.autosave_interval'], self._cbAutosave)
         self.connectActionCallbacks(ag)
         self._nr_tabs_changed()
         
         self.connect('switch-page', self._page_changed)
 
+    def _dispatchPageAction(self, action, method_name):
+        """Call the Action callback on the focused document"""
+        return getattr(self.currentDocument(), method_name)(action)
+
     def getUI(self):
         # TODO: standardize this as plugin method
         return self.action_group, uidesc
@@ -372,25 +1336,155 @@ class EditorBook(gtk.Notebook, ActionControllerMixin):
     def _cbFilenameChanged(self, document, prop):
         print 'CC', document.filename
         
+    def saveSession(self):
+        """Store the open files, their cursor lines and the focused tab
+        in the configuration"""
+        session = []
+        current = None
+        focused = self.currentDocument()
+        for document in self.documents():
+            if document.filename is None:
+                continue
+            if document is focused:
+                current = len(session)
+            session.append({'filename': document.filename,
+                            'line': document.getCursorLine()})
+        ctx['session.documents'] = session
+        ctx['session.current'] = current
+
+    def restoreSession(self):
+        """Reopen the files of the last session. Only the focused tab is
+        read; the others are materialized when first selected"""
+        focused = None
+        current = ctx['session.current']
+        for nr, entry in enumerate(ctx['session.documents'] or []):
+            filename = entry['filename']
+            if not os.path.isfile(filename):
+                continue
+            try:
+                document = self._createDocument(filename, lazy=True)
+            except DocumentExists:
+                continue
+            document.setCursorLine(entry.get('line', 0))
+            self.addDocument(document)
+            if nr == current:
+                focused = document
+        if focused is not None:
+            self.focusDocument(focused)
+        # bring the project index up to date before it is needed
+        self.projectIndex()
+
+    def _cbAutosave(self):
+        """Let the I/O workers append the queued edits to the swap files"""
+        for document in self.documents():
+            if document.swap is not None and document.swap.wantsSnapshot():
+                # replaces the log, which is not replayed to compact it
+                document.swap.snapshot(document.getText())
+            if document.swap is not None and document.swap.pending:
+                self.ioPool().submit(document.swap.flush)
+        return True
+
+    def _flushSwapFiles(self):
+        for document in self.documents():
+            if document.swap is not None:
+                document.swap.flush()
+
+    def _keepHistories(self):
+        for document in self.documents():
+            document.keepHistory()
+
+    def recoverSwapFiles(self):
+        """Offer to recover the unsaved changes left in swap files by a
+        mallet that crashed"""
+        from mallet.swap import recoverableSwapFiles
+        recoverable = recoverableSwapFiles()
+        if not recoverable:
+            return
+        names = [filename or 'Unsaved file'
+                 for paths, filename, text in recoverable]
+        msg = gtk.MessageDialog(parent=ctx.main_window,
+                                flags=gtk.DIALOG_MODAL,
+                                type=gtk.MESSAGE_QUESTION,
+                                message_format="Unsaved changes were left "
+                                "by a crash:\n%s\n\nRecover them?" %
+                                "\n".join(names))
+        msg.add_buttons(gtk.STOCK_DELETE, gtk.RESPONSE_NO,
+                        '_Recover', gtk.RESPONSE_YES)
+        response = msg.run()
+        msg.destroy()
+        if response not in (gtk.RESPONSE_YES, gtk.RESPONSE_NO):
+            return # ask again next time
+        for paths, filename, text in recoverable:
+            if response == gtk.RESPONSE_YES:
+                if filename and os.path.isfile(filename):
+                    document = Document(filename, lazy=True)
+                else:
+                    document = Document()
+                document.recover(text.encode('utf-8'))
+                self.addDocument(document)
+            for path in paths:
+                os.unlink(path)
+
     def _page_changed(self, notebook, page, page_num):
+        # the notebook may already number its pages without a page being
+        # removed, so the document is looked up from the page itself
         page = self.get_nth_page(page_num)
-        selected_doc = page.get_data('document-instance')
-        deselected_doc = self.currentDocument()
-        if deselected_doc:
-            deselected_doc.deselected()
-        if selected_doc:
-            selected_doc.selected()
+        self._select(page.get_data('document-instance'))
+
+    def _select(self, document):
+        """Make `document` (or None) the target of page actions"""
+        if self._current is not None:
+            self._current.deselected()
+        self._current = document
+        if document is not None:
+            # restored or hibernated documents are built when shown
+            document.materialize()
+            document.selected()
+            self._recent.remove(document)
+            self._recent.insert(0, document)
+            if self._budget_idle_id is None:
+                self._budget_idle_id = gobject.idle_add(self._enforceMemoryBudget)
+        self.find_bar.documentSelected(document)
+        self.outline_panel.documentSelected(document)
+        self.action_states.invalidate()
+
+    def memoryUsage(self):
+        """Return the estimated number of bytes held by all documents"""
+        total = 0
+        for document in self._recent:
+            total += document.memoryUsage()
+        return total
+
+    def _enforceMemoryBudget(self):
+        """Hibernate least recently selected documents until the memory
+        used is within 'editor.memory_budget' bytes"""
+        self._budget_idle_id = None
+        budget = ctx['editor.memory_budget']
+        total = self.memoryUsage()
+        current = self.currentDocument()
+        for document in self._recent[::-1]:
+            if total <= budget:
+                break
+            if document is current:
+                continue
+            usage = document.memoryUsage()
+            if document.hibernate():
+                total -= usage - document.memoryUsage()
+        return False
             
         
     def _nr_tabs_changed(self):
-        nr = self.get_n_pages()
-        sensitive = True
-        if nr == 0:
-            # disable page specific actions
-            sensitive = False
+        self.action_states.invalidate()
+
+    def _computeActionStates(self):
+        document = self.currentDocument()
+        states = {}
+        # page specific actions are disabled without pages
         for action_name in self.page_actions:
-            action = self.action_group.get_action(action_name)
-            action.set_sensitive(sensitive)
+            states[action_name] = document is not None
+        if document is not None and document.materialized:
+            states.update(document.actionStates())
+        return states
 
     def addDocument(self, document):
         """Add a document to notebook"""
@@ -398,47 +1492,140 @@ class EditorBook(gtk.Notebook, ActionControllerMixin):
         # tab label
         label = NotebookLabel(document.shortname or 'Unsaved file')
         label.close.connect('clicked', self.on_Close, document)
-        self.append_page(document.editor, label)
+        self._recent.insert(0, document)
+        # registered first: appending may switch to the page
+        Document.registry.appendPage(document, label)
+        self.append_page(document.page, label)
         self._nr_tabs_changed()
         document.connect('shortname-changed', self._cbShortnameChanged)
-        def modified_changed(buffer, document):
+        document.connect('load-finished', self._cbLoadFinished)
+        def modified_changed(document, modified):
             # set color of tab_label text
-            modified = document.getModified()
-            tab_label = self.get_tab_label(document.editor)
+            tab_label = Document.registry.label(document)
             if modified:
                 tab_label.set_color(0xFFFF, 0, 0)
             else:
                 tab_label.set_color(0,0,0)
+                # saved, so back on disk
+                self._forgetDeleted(document)
             
-        document.editor.buffer.connect_after('modified-changed', modified_changed, document)
-        if self.get_n_pages() == 1:
-            # switch-page signal wont be raised, so call selected() manually
-            document.selected()
+        document.connect('modified-changed', modified_changed)
+        if self._current is None:
+            # switch-page signal may not be raised for the first page
+            self._select(document)
     
     def _cbShortnameChanged(self, document, shortname):
-        label = self.get_tab_label(document.editor)
+        label = Document.registry.label(document)
         label.set_text(shortname)
 
+    def _cbLoadFinished(self, document, completed):
+        # a partially loaded file must not be edited and saved back
+        if not completed and Document.registry.hasPage(document):
+            self.removeDocument(document)
+
+    def _cbFilesChanged(self, changed):
+        """Reload the unmodified documents whose files changed on disk and
+        ask about the modified ones, all of a batch at once"""
+        self._disk_changes.update(changed)
+        if self._resolving_changes:
+            # a dialog is running; the loop below picks these up
+            return
+        self._resolving_changes = True
+        try:
+            while self._disk_changes:
+                changes = self._disk_changes
+                self._disk_changes = {}
+                self._resolveDiskChanges(changes)
+        finally:
+            self._resolving_changes = False
+
+    def resolveDiskChange(self, filename, signature):
+        """Handle `filename` having changed on disk as if the watcher
+        reported it"""
+        self._cbFilesChanged({filename: signature})
+
+    def _showDeleted(self):
+        if self._deleted:
+            self._deleted_status.set('Deleted on disk: %s' % ', '.join(
+                [document.filename for document in self._deleted]))
+        else:
+            self._deleted_status.clear()
+
+    def _forgetDeleted(self, document):
+        if document in self._deleted:
+            self._deleted.remove(document)
+            self._showDeleted()
+
+    def _resolveDiskChanges(self, changes):
+        conflicts = []
+        for filename, signature in changes.items():
+            document = Document.registry.lookup(filename)
+            if document is None or signature == document.disk_signature:
+                continue # closed meanwhile, or saved by us
+            if signature is None:
+                if document not in self._deleted:
+                    self._deleted.append(document)
+                if document.materialized:
+                    # saving puts it back
+                    document.setModified(True)
+                # else materialize shows it modified, having no text yet
+            elif document.getModified():
+                conflicts.append((document, signature))
+            elif document.materialized:
+                document.reload()
+        self._showDeleted()
+        if not conflicts:
+            return
+        msg = gtk.MessageDialog(parent=ctx.main_window,
+                                flags=gtk.DIALOG_MODAL,
+                                type=gtk.MESSAGE_WARNING,
+                                message_format="Changed on disk:\n%s\n\n"
+                                "Reload and lose your changes?" % "\n".join(
+            [document.filename for document, signature in conflicts]))
+        msg.add_buttons('_Keep Changes', gtk.RESPONSE_NO,
+                        gtk.STOCK_REFRESH, gtk.RESPONSE_YES)
+        response = msg.run()
+        msg.destroy()
+        for document, signature in conflicts:
+            if not Document.registry.hasPage(document):
+                continue # closed while the dialog was running
+            if response == gtk.RESPONSE_YES:
+                document.reload()
+            else:
+                # don't ask again until it changes once more
+                document.keepChanges(signature)
+
     def removeDocument(self, document):
         """Remove the document from notebook"""
-        self.remove_page(self.page_num(document.editor))
+        # the page stays registered while the notebook switches away from it
+        self.remove_page(self.page_num(document.page))
+        Document.registry.removePage(document)
+        if self._current is document:
+            # it was the last page
+            self._select(None)
+        self._recent.remove(document)
+        self._forgetDeleted(document)
         self._nr_tabs_changed()
         document.close()
         
     def focusDocument(self, document):
         """Bring the document to focus"""
-        nr = self.page_num(document.editor)
-        self.set_current_page(nr)
+        self.set_current_page(self.page_num(document.page))
+
+    def documents(self):
+        """Return the documents in tab order"""
+        return [page.get_data('document-instance')
+                for page in self.get_children()]
 
     def currentDocument(self):
         """Return the focused document"""
-        nr = self.get_current_page()
-        if nr == -1:
-            return None # no documents
-        editor = self.get_nth_page(nr)
-        document = editor.get_data('document-instance')
-        assert document
-        return document
+        return self._current
+
+    def ioPool(self):
+        """Return the WorkerPool for file I/O, created on first use"""
+        if self._io_pool is None:
+            self._io_pool = WorkerPool(ctx['editor.io_workers'])
+        return self._io_pool
         
     def saveDocument(self, document):
         """Try to save the document with user interaction, returning
@@ -460,21 +1647,221 @@ class EditorBook(gtk.Notebook, ActionControllerMixin):
         self.addDocument(document)
         self.focusDocument(document)
 
+    def _createDocument(self, filename, lazy=False):
+        if os.path.getsize(filename) >= ctx['editor.large_file_threshold']:
+            return LargeFileDocument(filename, lazy)
+        return Document(filename, lazy)
+
+    def openFile(self, filename):
+        """Open `filename` in a new tab, or focus its tab if already open.
+        Return the document"""
+        try:
+            document = self._createDocument(filename)
+            self.addDocument(document)
+        except DocumentExists, e:
+            document = e.document
+        self.focusDocument(document)
+        return document
+
+    def openFiles(self, filenames):
+        """Open `filenames` in new tabs (see `FileOpener`) and focus the
+        first"""
+        if filenames:
+            FileOpener(self, filenames)
+
+    def projectIndex(self):
+        """Return the `ProjectIndex` of 'project.root' (None if not set),
+        which is being brought up to date in the background"""
+        root = ctx['project.root']
+        if not root:
+            return None
+        if self._project is None or self._project.root != root:
+            from mallet.project import ProjectIndex
+            self._project = ProjectIndex(root, ctx['editor.project_ignore'])
+        self._project.refresh()
+        return self._project
+
+    def xrefIndex(self):
+        """Return the `XrefIndex` of the project (None if there is no
+        project root), which is being brought up to date in the
+        background"""
+        project = self.projectIndex()
+        if project is None:
+            return None
+        if self._xref is None or self._xref.project is not project:
+            if self._xref is not None:
+                # not joined, its thread may be waiting for the pool
+                self._xref.stop(wait=False)
+            else:
+                ctx.addCleanupCallback(lambda: self._xref.stop())
+            from mallet.xref import XrefIndex
+            self._xref = XrefIndex(project)
+        self._xref.update()
+        return self._xref
+
+    def on_ProjectRoot(self, widget):
+        root = FileDialog().folder('Project root', ctx.main_window)
+        if root:
+            ctx['project.root'] = root
+            # start the cross-reference indexing early
+            self.xrefIndex()
+
+    def on_QuickOpen(self, widget):
+        if self.projectIndex() is None:
+            self.on_ProjectRoot(widget)
+        index = self.projectIndex()
+        if index is not None:
+            from mallet.project import QuickOpen
+            QuickOpen(index, self.openFile, ctx.main_window).show()
+
+    def on_FindInFiles(self, widget):
+        if self.projectIndex() is None:
+            self.on_ProjectRoot(widget)
+        index = self.projectIndex()
+        if index is None:
+            return
+        search = self.find_results.ask(ctx.main_window)
+        if search is None:
+            return
+        # modified documents are searched as edited
+        texts = {}
+        for document in self.documents():
+            if document.filename and document.getModified():
+                path = os.path.realpath(document.filename)
+                texts[path] = document.getText()
+        def start():
+            if not index.ready:
+                return True
+            pattern, flags = search
+            self.find_results.find(index.files(), texts, pattern, flags,
+                                   index.root)
+            return False
+        if start():
+            self.find_results.cancel()
+            self.find_results.label.set_text('Indexing the project ...')
+            self.find_results.show()
+            gobject.timeout_add(200, start)
+
+    def _xrefQuery(self):
+        """Return (XrefIndex, name under the cursor) or None"""
+        name = self.currentDocument().wordAtCursor()
+        if name is None:
+            return None
+        if self.projectIndex() is None:
+            self.on_ProjectRoot(None)
+        xref = self.xrefIndex()
+        if xref is None:
+            return None
+        return xref, name
+
+    def _showXrefHits(self, title, xref, hits):
+        if xref.indexing:
+            title += ' (indexing)'
+        self.find_results.showHits(title, hits, xref.root)
+
+    def on_GotoDefinition(self, widget):
+        query = self._xrefQuery()
+        if query is None:
+            return
+        xref, name = query
+        found = xref.definitions(name)
+        if len(found) == 1:
+            path, line, kind, scope = found[0]
+            self.openFile(path).setCursorLine(line - 1)
+            return
+        hits = []
+        for path, line, kind, scope in found:
+            if scope:
+                hits.append((path, line, '%s %s.%s' % (kind, scope, name)))
+            else:
+                hits.append((path, line, '%s %s' % (kind, name)))
+        self._showXrefHits('Definitions of %s' % name, xref, hits)
+
+    def on_FindUsages(self, widget):
+        query = self._xrefQuery()
+        if query is None:
+            return
+        xref, name = query
+        hits = xref.usages(name)
+        self._showXrefHits('Usages of %s' % name, xref, hits)
+
     def on_Open(self, widget):
-        filename = FileDialog().open(ctx.main_window)
-        if filename:
-            document = None
-            try:
-                document = Document(filename)
-                self.addDocument(document)
-            except DocumentExists, e:
-                document = e.document
-            self.focusDocument(document)
+        self.openFiles(FileDialog().openMany(ctx.main_window))
 
     def on_Save(self, widget):
         document = self.currentDocument()
         self.saveDocument(document)
 
+    def on_SaveAll(self, widget):
+        pending = []
+        for document in self.documents():
+            if not document.getModified() or document.saving:
+                continue
+            if document.filename is None:
+                # ask for a name now, in the main loop
+                self.saveDocument(document)
+            else:
+                pending.append(document)
+        if not pending:
+            return
+        pool = self.ioPool()
+
+        status = StatusMessage('save-all')
+        status.set('Saving %d files ...' % len(pending))
+        remaining = [len(pending)]
+        errors = []
+        def saved(document, error):
+            if error is not None:
+                errors.append('%s: %s' % (document.filename, error))
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+            status.clear()
+            if errors:
+                msg = gtk.MessageDialog(parent=ctx.main_window,
+                                        flags=gtk.DIALOG_MODAL,
+                                        type=gtk.MESSAGE_ERROR,
+                                        buttons=gtk.BUTTONS_OK,
+                                        message_format="Could not save:\n" + 
+                                                       "\n".join(errors))
+                msg.run()
+                msg.destroy()
+        for document in pending:
+            try:
+                document.saveInBackground(pool, saved)
+            except DocumentReadOnly, e:
+                # reported with the others, the rest are still saved
+                saved(document, e)
+
+    def on_GotoLine(self, widget):
+        document = self.currentDocument()
+        line = askInteger('Go to Line', 'Line number:', 1,
+                          document.getLineCount(), ctx.main_window)
+        if line is not None:
+            document.gotoLine(line - 1)
+
+    def on_ShowOutline(self, action):
+        self.outline_panel.set_property('visible', action.get_active())
+
+    def on_GotoSymbol(self, widget):
+        self.action_group.get_action('ShowOutline').set_active(True)
+        self.outline_panel.gotoSymbol()
+
+    def on_Find(self, widget):
+        self.find_bar.open()
+
+    def on_FindNext(self, widget):
+        if self.find_bar.get_property('visible'):
+            self.find_bar.findNext()
+        else:
+            self.find_bar.open()
+
+    def on_FindPrevious(self, widget):
+        if self.find_bar.get_property('visible'):
+            self.find_bar.findNext(True)
+        else:
+            self.find_bar.open()
+
     def on_Close(self, widget, document=None):
         if document is None:
             document = self.currentDocument()
@@ -513,6 +1900,11 @@ class DocumentHasNoFilename(Exception):
 
     """Document was not given any filename (unnamed)"""
 
+class DocumentReadOnly(Exception):
+
+    """Document cannot be saved (eg: a large file viewer, a file which is
+    not UTF-8)"""
+
 
 
 uidesc = """
@@ -520,8 +1912,14 @@ uidesc = """
     <menu action="FileMenu">
       <menuitem action="New"/>
       <menuitem action="Open"/>
+      <menuitem action="QuickOpen"/>
+      <menuitem action="FindInFiles"/>
       <menuitem action="Save"/>
+      <menuitem action="SaveAll"/>
       <menuitem action="Close"/>
+      <menuitem action="Stop"/>
+      <separator/>
+      <menuitem action="ProjectRoot"/>
       <separator/>
     </menu>
     <menu action="EditMenu">
@@ -531,6 +1929,18 @@ uidesc = """
       <menuitem action="Cut"/>
       <menuitem action="Copy"/>
       <menuitem action="Paste"/>
+      <separator/>
+      <menuitem action="GotoLine"/>
+      <menuitem action="GotoSymbol"/>
+      <menuitem action="GotoDefinition"/>
+      <menuitem action="FindUsages"/>
+      <separator/>
+      <menuitem action="Find"/>
+      <menuitem action="FindNext"/>
+      <menuitem action="FindPrevious"/>
+    </menu>
+    <menu action="ViewMenu">
+      <menuitem action="ShowOutline"/>
     </menu>
   </menubar>
   <toolbar name="Toolbar">
@@ -538,6 +1948,7 @@ uidesc = """
     <separator/>
       <toolitem action="Open"/>
       <toolitem action="Save"/>
+      <toolitem action="Stop"/>
       <separator/>
       <toolitem action="Undo"/>
       <toolitem action="Redo"/>
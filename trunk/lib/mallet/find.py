@@ -0,0 +1,552 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Incremental search within a document
+
+A keystroke in the find bar costs one search from the current match and
+the highlighting of the matches around the visible region. All matches
+are only counted afterwards, in slices from idle callbacks; a longer query
+refines the matches of the shorter one instead of scanning the text again.
+"""
+
+import re
+import time
+import bisect
+
+import gobject
+import gtk
+
+
+class BufferSearch:
+
+    """Case insensitive search of the buffer of an `Editor`
+
+    Offsets count characters, as TextBuffer iterators do.
+
+    @ivar matches: Offsets of the matches found so far
+    @ivar scanned: Offset below which `matches` is complete
+    """
+
+    # seconds of counting per idle callback
+    slice_time = 0.01
+    # matches counted between clock checks
+    slice_matches = 2000
+    # milliseconds without edits before searching the edited text again
+    edit_delay = 300
+
+    def __init__(self, editor):
+        self.editor = editor
+        self.buffer = editor.buffer
+        self.query = u''
+        self.matches = []
+        self.scanned = 0
+        self.count_callback = None
+        self._text = None    # lower case text, None once edited
+        self._current = None # offset of the selected match
+        insert = self.buffer.get_iter_at_mark(self.buffer.get_insert())
+        self._origin = insert.get_offset()
+        self._tagged = None  # (start, end) of the highlighted region
+        self._job = None
+        self._idle_id = None
+        self._counted = False # are all matches in `matches`?
+        self._edit_id = None
+        self._tag = self.buffer.get_tag_table().lookup('search-match')
+        if self._tag is None:
+            self._tag = self.buffer.create_tag('search-match',
+                                               background='yellow')
+        self._handlers = [
+            (self.buffer, self.buffer.connect('changed', self._cbChanged)),
+            (editor.get_vadjustment(),
+             editor.get_vadjustment().connect('value-changed',
+                                              self._cbScrolled)),
+            ]
+
+    def close(self):
+        """Stop searching and remove the highlights"""
+        self._stopCount()
+        if self._edit_id is not None:
+            gobject.source_remove(self._edit_id)
+            self._edit_id = None
+        self._untag()
+        for obj, handler_id in self._handlers:
+            obj.disconnect(handler_id)
+        self._handlers = []
+
+    def _getText(self):
+        if self._text is None:
+            start, end = self.buffer.get_bounds()
+            self._text = self.buffer.get_text(start, end).decode('utf-8').lower()
+        return self._text
+
+    def _cbChanged(self, buffer):
+        # the matches no longer apply; highlights move along with the text
+        # until the edits pause
+        self._text = None
+        self._stopCount()
+        self.matches = []
+        self.scanned = 0
+        if self._edit_id is not None:
+            gobject.source_remove(self._edit_id)
+        self._edit_id = gobject.timeout_add(self.edit_delay, self._cbEdited)
+
+    def _cbEdited(self):
+        """Highlight and count the matches in the edited text"""
+        self._edit_id = None
+        if not self.query:
+            return False
+        text = self._getText()
+        self._untag()
+        self._highlight()
+        self._startCount(self.query, text, (), 0)
+        return False
+
+    # querying
+
+    def setQuery(self, query, count_callback=None, found_callback=None):
+        """Select the first match of `query` from the current match (or
+        where the search started). Return False if there is none.
+        `count_callback(count, number)` is called once all matches are
+        counted, `number` being that of the selected match. The result is
+        returned at once, `found_callback` is for `MappedSearch`"""
+        query = query.lower()
+        text = self._getText()
+        previous, previous_end = (), 0
+        if self.query and query.startswith(self.query):
+            # refine the matches of the shorter query
+            previous, previous_end = self.matches, self.scanned
+        if self.query and query.startswith(self.query) and \
+           self._current is not None:
+            start = self._current
+        else:
+            start = self._origin
+        self._stopCount()
+        self._untag()
+        self.query = query
+        self.count_callback = count_callback
+        self.matches = []
+        self.scanned = 0
+        self._current = None
+        if not query:
+            return True
+        found = text.find(query, start)
+        if found == -1:
+            found = text.find(query)
+        if found == -1:
+            return False
+        self._select(found)
+        self._highlight()
+        self._startCount(query, text, previous, previous_end)
+        return True
+
+    def findNext(self, backward=False):
+        """Select the next (or previous) match, wrapping around. Return
+        False if there is none"""
+        if not self.query:
+            return False
+        text = self._getText()
+        query = self.query
+        if self._current is None:
+            position = self._origin
+        else:
+            position = self._current
+        if backward:
+            found = text.rfind(query, 0, position + len(query) - 1)
+            if found == -1:
+                found = text.rfind(query)
+        else:
+            found = text.find(query, position + 1)
+            if found == -1:
+                found = text.find(query)
+        if found == -1:
+            return False
+        self._select(found)
+        self._highlight()
+        if self._counted and self.count_callback is not None:
+            self._reportCount()
+        return True
+
+    def _select(self, offset):
+        self._current = offset
+        buffer = self.buffer
+        start = buffer.get_iter_at_offset(offset)
+        end = buffer.get_iter_at_offset(offset + len(self.query))
+        buffer.select_range(start, end)
+        self.editor.view.scroll_to_mark(buffer.get_insert(), 0.25)
+
+    # highlighting
+
+    def _visibleRange(self):
+        """Return the offsets of the visible region, extended by a page
+        above and below"""
+        adjustment = self.editor.get_vadjustment()
+        view = self.editor.view
+        top = max(0, int(adjustment.value - adjustment.page_size))
+        bottom = int(adjustment.value + 2 * adjustment.page_size)
+        start = view.get_line_at_y(top)[0]
+        end = view.get_line_at_y(bottom)[0]
+        end.forward_to_line_end()
+        return start.get_offset(), end.get_offset()
+
+    def _highlight(self):
+        """Tag the matches of the region around the view which are not
+        tagged yet"""
+        if not self.query or self._text is None:
+            return
+        start, end = self._visibleRange()
+        if self._tagged is None or start > self._tagged[1] or \
+           end < self._tagged[0]:
+            # scrolled far away, start over
+            self._untag()
+            self._tag_range(start, end)
+            self._tagged = (start, end)
+            return
+        tagged_start, tagged_end = self._tagged
+        if start < tagged_start:
+            self._tag_range(start, tagged_start)
+        if end > tagged_end:
+            self._tag_range(tagged_end, end)
+        self._tagged = (min(start, tagged_start), max(end, tagged_end))
+
+    def _tag_range(self, start, end):
+        """Tag the matches starting from `start` to before `end`"""
+        text, query, buffer = self._text, self.query, self.buffer
+        length = len(query)
+        found = text.find(query, start, end + length - 1)
+        while found != -1:
+            buffer.apply_tag(self._tag, buffer.get_iter_at_offset(found),
+                             buffer.get_iter_at_offset(found + length))
+            found = text.find(query, found + 1, end + length - 1)
+
+    def _untag(self):
+        if self._tagged is None:
+            return
+        self._tagged = None
+        # edits may have moved the highlights out of the tagged region;
+        # the cost is that of the tag toggles, not of the text length
+        start, end = self.buffer.get_bounds()
+        self.buffer.remove_tag(self._tag, start, end)
+
+    def _cbScrolled(self, adjustment):
+        self._highlight()
+
+    # counting
+
+    def _count(self, query, text, previous, previous_end):
+        """Generator collecting the matches of `query` into `matches`,
+        yielding every `slice_matches` of them. The `previous` matches of
+        a prefix of `query`, complete below `previous_end`, are filtered
+        and only the text after them is scanned"""
+        matches = self.matches
+        n = 0
+        startswith = text.startswith
+        for offset in previous:
+            if offset >= previous_end:
+                break
+            if startswith(query, offset):
+                matches.append(offset)
+            n += 1
+            if n == self.slice_matches:
+                n = 0
+                self.scanned = offset + 1
+                yield None
+        find = text.find
+        offset = find(query, previous_end)
+        while offset != -1:
+            matches.append(offset)
+            n += 1
+            if n == self.slice_matches:
+                n = 0
+                self.scanned = offset + 1
+                yield None
+            offset = find(query, offset + 1)
+        self.scanned = len(text)
+
+    def _startCount(self, query, text, previous, previous_end):
+        self._stopCount()
+        self._job = self._count(query, text, previous, previous_end)
+        self._idle_id = gobject.idle_add(self._cbCount)
+
+    def _cbCount(self):
+        deadline = time.time() + self.slice_time
+        for dummy in self._job:
+            if time.time() > deadline:
+                return True
+        self._job = None
+        self._idle_id = None
+        self._counted = True
+        if self.count_callback is not None and self._current is not None:
+            self._reportCount()
+        return False
+
+    def _reportCount(self):
+        number = bisect.bisect_left(self.matches, self._current) + 1
+        self.count_callback(len(self.matches), number)
+
+    def _stopCount(self):
+        if self._idle_id is not None:
+            gobject.source_remove(self._idle_id)
+            self._idle_id = None
+        self._job = None
+        self._counted = False
+
+
+def _caselessPattern(query):
+    """Return a regular expression matching the UTF-8 encoding of `query`
+    whatever the case of its characters, and the most bytes it matches"""
+    parts = []
+    longest = 0
+    for c in query:
+        variants = set([c, c.lower(), c.upper()])
+        encoded = sorted([variant.encode('utf-8') for variant in variants])
+        longest += max([len(variant) for variant in encoded])
+        parts.append('(?:%s)' % '|'.join([re.escape(variant)
+                                          for variant in encoded]))
+    return re.compile(''.join(parts)), longest
+
+
+class MappedSearch:
+
+    """Case insensitive search of the file of a `LargeFileViewer`, with
+    the interface of `BufferSearch`
+
+    The mapped file is scanned a chunk at a time from idle callbacks, so
+    that a query which is not found does not stall the main loop. Chunks
+    start at `chunk_size` bytes and are resized from the measured speed to
+    take about half of `slice_time`; `setQuery` and `findNext` return None and the outcome is passed
+    to `found_callback(found)`. Matches are neither counted nor
+    highlighted.
+    """
+
+    chunk_size = 1 << 18
+    min_chunk_size = 1 << 14
+    max_chunk_size = 1 << 22
+    # seconds of scanning per idle callback
+    slice_time = 0.01
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.query = u''
+        self.found_callback = None
+        self._pattern = None
+        self._longest = 0
+        self._origin = viewer.index.lineOffset(viewer.cursorLine())
+        self._current = None # byte offset of the selected match
+        self._chunk = self.chunk_size
+        self._job = None
+        self._idle_id = None
+
+    def close(self):
+        self._stop()
+
+    def setQuery(self, query, count_callback=None, found_callback=None):
+        extend = self.query and self._current is not None and \
+                 query.lower().startswith(self.query.lower())
+        if extend:
+            start = self._current
+        else:
+            start = self._origin
+        self._stop()
+        self.query = query
+        self.found_callback = found_callback
+        self._current = None
+        if not query:
+            return True
+        self._pattern, self._longest = _caselessPattern(query)
+        self._start(start, False)
+        return None
+
+    def findNext(self, backward=False):
+        if not self.query:
+            return False
+        if self._current is None:
+            position = self._origin
+        elif backward:
+            position = self._current
+        else:
+            position = self._current + 1
+        self._start(position, backward)
+        return None
+
+    def _start(self, position, backward):
+        self._stop()
+        if backward:
+            self._job = self._scanBackward(position)
+        else:
+            self._job = self._scanForward(position)
+        self._idle_id = gobject.idle_add(self._cbScan)
+
+    def _stop(self):
+        if self._idle_id is not None:
+            gobject.source_remove(self._idle_id)
+            self._idle_id = None
+        self._job = None
+
+    def _scanForward(self, position):
+        """Generator yielding None after each chunk and the first match
+        from `position` on, wrapping around"""
+        mm, pattern = self.viewer.mm, self._pattern
+        size = len(mm)
+        for low, high in ((position, size), (0, min(position, size))):
+            # matches starting from low to before high
+            while low < high:
+                end = min(low + self._chunk, high)
+                match = pattern.search(mm, low, min(end + self._longest, size))
+                if match is not None and match.start() < end:
+                    yield match
+                    return
+                low = end
+                yield None
+
+    def _scanBackward(self, position):
+        """Generator yielding None after each chunk and the last match
+        before `position`, wrapping around"""
+        mm, pattern = self.viewer.mm, self._pattern
+        size = len(mm)
+        for low, high in ((0, min(position, size)), (position, size)):
+            while low < high:
+                start = max(high - self._chunk, low)
+                last = None
+                for match in pattern.finditer(mm, start,
+                                              min(high + self._longest, size)):
+                    if match.start() >= high:
+                        break
+                    last = match
+                if last is not None:
+                    yield last
+                    return
+                high = start
+                yield None
+
+    def _cbScan(self):
+        deadline = time.time() + self.slice_time
+        match = None
+        # the file may have been truncated since the last slice
+        if not self.viewer.mapValid():
+            self._job = ()
+        last = time.time()
+        for match in self._job:
+            if match is not None:
+                self._current = match.start()
+                length = len(match.group().decode('utf-8', 'replace'))
+                self.viewer.showMatch(self._current, length)
+                break
+            now = time.time()
+            chunk = self._chunk * self.slice_time / 2 / max(now - last, 1e-4)
+            self._chunk = int(min(max(chunk, self.min_chunk_size),
+                                  self.max_chunk_size))
+            last = now
+            if now > deadline:
+                return True
+        self._job = None
+        self._idle_id = None
+        if self.found_callback is not None:
+            self.found_callback(match is not None)
+        return False
+
+
+class FindBar(gtk.HBox):
+
+    """Find bar searching the current document of `editorbook` as the
+    text is typed"""
+
+    def __init__(self, editorbook):
+        gtk.HBox.__init__(self, spacing=4)
+        self.editorbook = editorbook
+        self.document = None
+        self.entry = gtk.Entry()
+        self.entry.connect('changed', self._cbChanged)
+        self.entry.connect('activate', lambda entry: self.findNext())
+        self.entry.connect('key-press-event', self._cbKeyPress)
+        previous = gtk.Button(stock=gtk.STOCK_GO_UP)
+        previous.connect('clicked', lambda button: self.findNext(True))
+        following = gtk.Button(stock=gtk.STOCK_GO_DOWN)
+        following.connect('clicked', lambda button: self.findNext())
+        self.label = gtk.Label()
+        close = gtk.Button(stock=gtk.STOCK_CLOSE)
+        close.connect('clicked', lambda button: self.close())
+        self.pack_start(gtk.Label('Find:'), False)
+        self.pack_start(self.entry, False)
+        self.pack_start(previous, False)
+        self.pack_start(following, False)
+        self.pack_start(self.label, False)
+        self.pack_end(close, False)
+        for child in self.get_children():
+            child.show()
+
+    def open(self):
+        """Show the bar and focus the entry"""
+        self.show()
+        self.entry.grab_focus()
+        self.entry.select_region(0, -1)
+        self.documentSelected(self.editorbook.currentDocument())
+
+    def close(self):
+        self._endSearch()
+        self.hide()
+        document = self.editorbook.currentDocument()
+        if document is not None:
+            document.editor.view.grab_focus()
+
+    def documentSelected(self, document):
+        """Search `document` instead, if the bar is shown"""
+        if document is self.document or not self.get_property('visible'):
+            return
+        self._endSearch()
+        self.document = document
+        if document is not None and self.entry.get_text():
+            self._search()
+
+    def findNext(self, backward=False):
+        if self.document is None:
+            return
+        found = self.document.searchNext(backward)
+        if found is not None:
+            self._cbFound(found)
+
+    def _endSearch(self):
+        if self.document is not None:
+            self.document.endSearch()
+            self.document = None
+        self.label.set_text('')
+
+    def _search(self):
+        self.label.set_text('')
+        found = self.document.search(self.entry.get_text().decode('utf-8'),
+                                     self._cbCounted, self._cbFound)
+        # None while a `MappedSearch` goes on
+        if found is not None:
+            self._cbFound(found)
+
+    def _cbFound(self, found):
+        if found:
+            self.entry.modify_base(gtk.STATE_NORMAL, None)
+        else:
+            self.entry.modify_base(gtk.STATE_NORMAL,
+                                   gtk.gdk.color_parse('#ff6666'))
+            self.label.set_text('Not found')
+
+    def _cbChanged(self, entry):
+        if self.document is not None:
+            self._search()
+
+    def _cbCounted(self, count, number):
+        self.label.set_text('%d of %d' % (number, count))
+
+    def _cbKeyPress(self, entry, event):
+        if gtk.gdk.keyval_name(event.keyval) == 'Escape':
+            self.close()
+            return True
+        return False
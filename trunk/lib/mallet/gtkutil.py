@@ -19,6 +19,7 @@
 import sys
 import os.path
 import inspect
+import gobject
 import gtk
 import pango
 
@@ -57,6 +58,94 @@ class NotebookLabel(gtk.HBox):
         self.text.set_attributes(list)
 
 
+class StatusMessage:
+
+    """A message in the main window statusbar that can be replaced in place"""
+
+    def __init__(self, context='mallet'):
+        self.context = context
+        self._message_id = None
+
+    def _statusbar(self):
+        return getattr(ctx.main_window, 'statusbar', None)
+
+    def set(self, text):
+        """Show `text`, replacing the previous message if any"""
+        statusbar = self._statusbar()
+        if statusbar is None:
+            return
+        self.clear()
+        context_id = statusbar.get_context_id(self.context)
+        self._message_id = statusbar.push(context_id, text)
+
+    def clear(self):
+        """Remove the message from the statusbar"""
+        statusbar = self._statusbar()
+        if statusbar is None or self._message_id is None:
+            return
+        context_id = statusbar.get_context_id(self.context)
+        statusbar.remove(context_id, self._message_id)
+        self._message_id = None
+
+
+class ActionSensitivity:
+
+    """Keep the sensitivity of Actions in step with some state, lazily
+
+    `invalidate` only marks the state dirty. At most once per idle cycle,
+    `compute()` is called to get {action_name: sensitive} and set_sensitive
+    is called only for the actions whose sensitivity actually changed.
+    """
+
+    def __init__(self, action_group, compute):
+        self.action_group = action_group
+        self.compute = compute
+        self._actions = {}    # action_name -> Action
+        self._applied = {}    # action_name -> last sensitivity set
+        self._idle_id = None
+
+    def invalidate(self):
+        """Recompute the states on the next idle cycle"""
+        if self._idle_id is None:
+            self._idle_id = gobject.idle_add(self._update)
+
+    def _update(self):
+        self._idle_id = None
+        for action_name, sensitive in self.compute().items():
+            if self._applied.get(action_name) == sensitive:
+                continue
+            action = self._actions.get(action_name)
+            if action is None:
+                action = self.action_group.get_action(action_name)
+                self._actions[action_name] = action
+            action.set_sensitive(sensitive)
+            self._applied[action_name] = sensitive
+        return False
+
+
+def askInteger(title, text, lower, upper, parent=None):
+    """Ask the user for a number between `lower` and `upper`, return None
+    if the dialog was cancelled"""
+    dlg = gtk.Dialog(title, parent, gtk.DIALOG_MODAL|gtk.DIALOG_DESTROY_WITH_PARENT,
+                     (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                      gtk.STOCK_OK, gtk.RESPONSE_OK))
+    dlg.set_default_response(gtk.RESPONSE_OK)
+    adjustment = gtk.Adjustment(lower, lower, upper, 1, 10)
+    spin = gtk.SpinButton(adjustment)
+    spin.set_activates_default(True)
+    hbox = gtk.HBox(spacing=6)
+    hbox.set_border_width(6)
+    hbox.pack_start(gtk.Label(text), False)
+    hbox.pack_start(spin, True)
+    dlg.vbox.pack_start(hbox)
+    dlg.show_all()
+    value = None
+    if dlg.run() == gtk.RESPONSE_OK:
+        value = spin.get_value_as_int()
+    dlg.destroy()
+    return value
+
+
 class GtkExceptionReporter:
 
     """Handlers all exception globally and reports data in a dialog 
@@ -100,23 +189,36 @@ class ActionControllerMixin:
     During __init__, call the single method `connectActionCallbacks` passing
     the ActionGroup which contains the Actions. All callback methods in the
     class will be automatically connected to the appropriate Action
+
+    The on_<action_name> methods are looked up once per class (see
+    `actionCallbacks`), not on every instance.
     """
 
+    def actionCallbacks(cls):
+        """Return ((action_name, method_name), ...) for the on_<action_name>
+        methods of `cls` and its bases"""
+        # look in the class' own dict; a subclass may define more callbacks
+        callbacks = cls.__dict__.get('_action_callbacks')
+        if callbacks is None:
+            startWith = 'on_'
+            names = {}
+            for klass in inspect.getmro(cls):
+                for name, value in klass.__dict__.items():
+                    if name.startswith(startWith) and inspect.isfunction(value):
+                        names[name] = True
+            callbacks = [(name[len(startWith):], name) for name in names]
+            callbacks.sort()
+            callbacks = tuple(callbacks)
+            cls._action_callbacks = callbacks
+        return callbacks
+    actionCallbacks = classmethod(actionCallbacks)
+
     def connectActionCallbacks(self, action_group):
-        """Connect cb_<action_name> methods to the corresponding Actions"""
-        # generate Action names list from callback methods
-        methods = [x[0] for x in inspect.getmembers(self) \
-                   if inspect.ismethod(x[1])]
-        startWith = 'on_'
-        actions_list = [x[len(startWith):] for x in methods \
-                        if x.startswith(startWith)]
-
-        # Connect the callback for each action
-        for action_name in actions_list:
+        """Connect on_<action_name> methods to the corresponding Actions"""
+        for action_name, method_name in self.actionCallbacks():
             action = action_group.get_action(action_name)
-            callback = getattr(self, '%s%s' % (startWith, action_name))
             # The "activate" signal is emitted when Action is 'performed'.
-            action.connect("activate", callback)
+            action.connect("activate", getattr(self, method_name))
 
 
 class FileDialog:
@@ -130,6 +232,34 @@ class FileDialog:
         dlg = self.getOpenDlg(parent=parent)
         return self.getFilename(dlg, True)
 
+    def openMany(self, parent=None):
+        """Return the list of existing files selected (empty if the dialog
+        was cancelled)"""
+        dlg = self.getOpenDlg(title="Open files", parent=parent)
+        dlg.set_select_multiple(True)
+        if FileDialog.last_accessed:
+            dlg.set_current_folder(FileDialog.last_accessed)
+        dlg.set_default_response(gtk.RESPONSE_OK)
+        filenames = []
+        if dlg.run() == gtk.RESPONSE_OK:
+            filenames = [f for f in dlg.get_filenames() if os.path.isfile(f)]
+        dlg.destroy()
+        if filenames:
+            FileDialog.last_accessed = os.path.dirname(filenames[0])
+        return filenames
+
+    def folder(self, title="Select folder", parent=None):
+        """Return the directory selected by the user, or None"""
+        dlg = gtk.FileChooserDialog(title, parent,
+                              action=gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER,
+                              buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,gtk.STOCK_OPEN,gtk.RESPONSE_OK))
+        dlg.set_default_response(gtk.RESPONSE_OK)
+        directory = None
+        if dlg.run() == gtk.RESPONSE_OK:
+            directory = dlg.get_filename()
+        dlg.destroy()
+        return directory
+
     def save(self, parent=None):
         dlg = self.getSaveDlg(parent=parent)
         return self.getFilename(dlg, False, True)
@@ -211,4 +341,5 @@ color_purple       = chr(27) + "[35;1m"
 color_bright_cyan  = chr(27) + "[36;1m"
 color_white        = chr(27) + "[37;1m"
 
-__all__ = ['FileDialog', 'ActionControllerMixin', 'NotebookLabel']
+__all__ = ['FileDialog', 'ActionControllerMixin', 'NotebookLabel',
+           'StatusMessage', 'ActionSensitivity', 'askInteger']
@@ -0,0 +1,105 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Single instance support
+
+The first instance listens on a per-user Unix domain socket. Later
+invocations of bin/mallet send their file arguments to it (one absolute
+path per line) and exit without ever importing GTK.
+"""
+
+import os
+import os.path
+import socket
+import errno
+
+
+def socketPath():
+    """Return the socket path of this user (per host, as ~ may be shared)"""
+    return os.path.expanduser('~/.config/mallet/socket-%s' % socket.gethostname())
+
+
+def sendToRunning(filenames):
+    """Send `filenames` to the running instance. Return False if there is
+    no running instance"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socketPath())
+        except socket.error:
+            return False
+        message = ''.join(['%s\n' % os.path.abspath(f) for f in filenames])
+        sock.sendall(message)
+    finally:
+        sock.close()
+    return True
+
+
+class InstanceServer:
+
+    """Accept file lists from other invocations and pass them to
+    `open_callback(filenames)` in the main loop"""
+
+    def __init__(self, open_callback):
+        self.open_callback = open_callback
+        self.path = socketPath()
+        self.sock = None
+
+    def start(self):
+        """Start listening. Return False if another instance got there first"""
+        # not at module level: forwarding files must not load GTK
+        import gobject
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+        except socket.error, e:
+            if e.args[0] != errno.EADDRINUSE or sendToRunning([]):
+                sock.close()
+                return False
+            # left behind by an instance that crashed
+            os.unlink(self.path)
+            sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        sock.listen(5)
+        self.sock = sock
+        gobject.io_add_watch(sock, gobject.IO_IN, self._cbAccept)
+        return True
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            os.unlink(self.path)
+
+    def _cbAccept(self, sock, condition):
+        import gobject
+        conn, address = sock.accept()
+        gobject.io_add_watch(conn, gobject.IO_IN | gobject.IO_HUP,
+                             self._cbRead, [])
+        return True
+
+    def _cbRead(self, conn, condition, chunks):
+        data = conn.recv(4096)
+        if data:
+            chunks.append(data)
+            return True
+        conn.close()
+        filenames = [f for f in ''.join(chunks).split('\n') if f]
+        self.open_callback(filenames)
+        return False
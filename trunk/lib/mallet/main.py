@@ -16,11 +16,15 @@
 
 """Main module"""
 
+import sys
 import os.path
+from mallet.util import startup_timer
 import pygtk
 pygtk.require('2.0')
+import gobject
 import gtk
 from gtk import gdk
+startup_timer.mark('import gtk')
 
 def get_main_wind():
     return MainWindow.instance
@@ -29,24 +33,65 @@ def get_main_wind():
 import mallet.context
 mallet.context.init_context(get_main_wind)
 from mallet.context import ctx
+startup_timer.mark('config load')
 
 from mallet.editor import EditorBook
 from mallet.config import pixmaps_dir
 from mallet.gtkutil import ActionControllerMixin
-
-
-def run():
-    """Start the application"""
-    gtk.window_set_default_icon(MainWindow.logo)
+from mallet.ipc import InstanceServer
+from mallet.search import FileSearch
+startup_timer.mark('import mallet')
+
+
+def run(filenames=(), single_instance=True):
+    """Start the application, opening `filenames`. If `single_instance`,
+    later invocations of mallet will send their files to this one"""
+    # forked before any thread is started
+    FileSearch.getPool()
+    # background workers (eg: line indexing) must run while in gtk.main()
+    gobject.threads_init()
     w = MainWindow()
     MainWindow.instance = w
+    startup_timer.mark('window build')
+    # recovered files are not reopened by the session restore
+    w.editorbook.recoverSwapFiles()
+    w.editorbook.restoreSession()
+    startup_timer.mark('session restore')
+    if single_instance:
+        server = InstanceServer(w.openFiles)
+        if server.start():
+            ctx.addCleanupCallback(server.stop)
     for child in w.get_children():
         w.show_all()
     w.maximize()
     w.show()
+    if filenames:
+        w.openFiles(filenames)
+
+    def first_expose(widget, event):
+        w.disconnect(expose_id)
+        startup_timer.mark('first expose')
+        if startup_timer.enabled:
+            startup_timer.report()
+        # the icon can wait until something is on screen
+        gobject.idle_add(set_icon)
+        return False
+    def set_icon():
+        gtk.window_set_default_icon(getLogo())
+        w.set_icon(getLogo())
+        return False
+    expose_id = w.connect_after('expose-event', first_expose)
     gtk.main()
 
 
+def getLogo():
+    """Return the application logo, loaded on first use"""
+    if MainWindow.logo is None:
+        filename = os.path.join(pixmaps_dir, 'mallet.png')
+        MainWindow.logo = gdk.pixbuf_new_from_file(filename)
+    return MainWindow.logo
+
+
 
 class MainWindow(gtk.Window, ActionControllerMixin):
 
@@ -54,7 +99,8 @@ class MainWindow(gtk.Window, ActionControllerMixin):
     
     instance = None
     
-    logo = gdk.pixbuf_new_from_file(os.path.join(pixmaps_dir, 'mallet.png'))
+    # see `getLogo`
+    logo = None
 
     def __init__(self):
         gtk.Window.__init__(self)
@@ -73,6 +119,7 @@ class MainWindow(gtk.Window, ActionControllerMixin):
                                   'Quit the Program', ncb),
                                  ('FileMenu', None, '_File'),
                                  ('EditMenu', None, '_Edit'),
+                                 ('ViewMenu', None, '_View'),
                                  ])
 
         actiongroup.add_actions([('About', None, '_About', None,
@@ -82,7 +129,7 @@ class MainWindow(gtk.Window, ActionControllerMixin):
         uim.insert_action_group(actiongroup, 0)
         merge_id = uim.add_ui_from_string(uidesc)
 
-        e = EditorBook()
+        self.editorbook = e = EditorBook()
         e.show()
         e_ag, e_uidesc = e.getUI()
         uim.insert_action_group(e_ag, 1)
@@ -95,8 +142,24 @@ class MainWindow(gtk.Window, ActionControllerMixin):
         toolbar.set_style(gtk.TOOLBAR_ICONS)
         vbox.pack_start(menubar, False)
         vbox.pack_start(toolbar, False)
-        vbox.pack_start(e, True)
-        vbox.pack_start(gtk.Statusbar(), False)
+        # find in files results below the documents, shown when used
+        paned = gtk.VPaned()
+        paned.pack1(e, True, False)
+        paned.pack2(e.find_results, False, True)
+        e.find_results.set_no_show_all(True)
+        paned.show()
+        # outline of the current document on the left, shown when used
+        outline = gtk.HPaned()
+        outline.pack1(e.outline_panel, False, True)
+        outline.pack2(paned, True, False)
+        e.outline_panel.set_no_show_all(True)
+        e.outline_panel.set_size_request(200, -1)
+        outline.show()
+        vbox.pack_start(outline, True)
+        e.find_bar.set_no_show_all(True)
+        vbox.pack_start(e.find_bar, False)
+        self.statusbar = gtk.Statusbar()
+        vbox.pack_start(self.statusbar, False)
 
         self.add(vbox)
         
@@ -105,6 +168,17 @@ class MainWindow(gtk.Window, ActionControllerMixin):
         self.connect('delete_event', lambda *args: False)
         self.connect('destroy', self.on_Quit)
 
+    def openFiles(self, filenames):
+        """Open (or focus) each of `filenames` and raise the window"""
+        existing = []
+        for filename in filenames:
+            if os.path.isfile(filename):
+                existing.append(filename)
+            else:
+                print >> sys.stderr, 'mallet: cannot open %s' % filename
+        self.editorbook.openFiles(existing)
+        self.present()
+
     def on_About(self, widget):
         dlg = gtk.AboutDialog()
         dlg.set_name('GNOME Mallet')
@@ -112,7 +186,7 @@ class MainWindow(gtk.Window, ActionControllerMixin):
         dlg.set_comments('GNOME RAD')
         dlg.set_website('http://mallet.berlios.de')
         dlg.set_authors(['Sridhar Ratna'])
-        dlg.set_logo(self.logo)
+        dlg.set_logo(getLogo())
         dlg.set_transient_for(ctx.main_window)
         dlg.run()
         dlg.destroy()
@@ -129,6 +203,8 @@ uidesc = """
     </menu>
     <menu action="EditMenu">
     </menu>
+    <menu action="ViewMenu">
+    </menu>
     <menu action="HelpMenu">
       <menuitem action="About" position="bot"/>
     </menu>
@@ -0,0 +1,255 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Outline of Python documents
+
+An outline lists the classes, functions, methods and imports of a text as
+(kind, name, line, depth) tuples, lines counted from 0. Texts are parsed
+by a separate process, as parsing in a thread would hold the interpreter
+lock away from the main loop. Outlines are cached by the SHA-1 of the
+text, in memory and under ~/.config/mallet/outline; the disk cache keeps
+the 'editor.outline_cache_files' most recently used outlines.
+"""
+
+import os
+import os.path
+import re
+import ast
+import marshal
+import hashlib
+import collections
+
+import gobject
+import gtk
+
+from mallet.context import ctx
+from mallet.util import atomicWrite
+
+
+def parseOutline(text):
+    """Return the outline of the Python source `text`. Text which does
+    not parse (eg: while being typed) is scanned for definitions"""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, TypeError, ValueError):
+        return _scanOutline(text)
+    outline = []
+    _walk(tree.body, 0, False, outline)
+    return outline
+
+
+def _walk(nodes, depth, in_class, outline):
+    for node in nodes:
+        if isinstance(node, ast.ClassDef):
+            outline.append(('class', node.name, node.lineno - 1, depth))
+            _walk(node.body, depth + 1, True, outline)
+        elif isinstance(node, ast.FunctionDef):
+            if in_class:
+                kind = 'method'
+            else:
+                kind = 'function'
+            outline.append((kind, node.name, node.lineno - 1, depth))
+            _walk(node.body, depth + 1, False, outline)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                outline.append(('import', alias.asname or alias.name,
+                                node.lineno - 1, depth))
+        else:
+            # definitions within if, try, for, ... blocks
+            for field in ('body', 'orelse', 'handlers', 'finalbody'):
+                _walk(getattr(node, field, ()), depth, in_class, outline)
+
+
+_definition = re.compile(r'^([ \t]*)(?:(class|def)[ \t]+(\w+)|'
+                         r'(?:import|from)[ \t]+([\w.]+))', re.M)
+
+def _scanOutline(text):
+    outline = []
+    enclosing = [] # (indentation, keyword) of the definitions around
+    line = 0
+    pos = 0
+    for match in _definition.finditer(text):
+        line += text.count('\n', pos, match.start())
+        pos = match.start()
+        indentation = len(match.group(1).expandtabs())
+        while enclosing and enclosing[-1][0] >= indentation:
+            enclosing.pop()
+        keyword = match.group(2)
+        if keyword is None:
+            outline.append(('import', match.group(4), line, len(enclosing)))
+            continue
+        if keyword == 'class':
+            kind = 'class'
+        elif enclosing and enclosing[-1][1] == 'class':
+            kind = 'method'
+        else:
+            kind = 'function'
+        outline.append((kind, match.group(3), line, len(enclosing)))
+        enclosing.append((indentation, keyword))
+    return outline
+
+
+def outlineDirectory():
+    directory = os.path.join(ctx.app_settings_directory, 'outline')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def outlineTask(task):
+    """Return the outline of a text, from the disk cache if there.
+    Run by the parsing process; `task` is (cache path, text)"""
+    path, text = task
+    try:
+        outline = marshal.loads(open(path, 'rb').read())
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    else:
+        # mark it used, see pruneOutlineCache
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return outline
+    outline = parseOutline(text)
+    try:
+        atomicWrite(path, [marshal.dumps(outline)])
+    except (IOError, OSError):
+        pass
+    return outline
+
+
+def pruneOutlineCache(directory, max_entries):
+    """Delete all but the `max_entries` most recently used outlines of
+    the disk cache. Run by the parsing process"""
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    entries.sort()
+    for mtime, path in entries[:-max_entries or None]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class OutlineParser:
+
+    """Parse outlines in a separate process
+
+    @cvar cache_size: Outlines kept in memory
+    """
+
+    # created on first use
+    pool = None
+    cache_size = 200
+    _cache = {} # SHA-1 -> outline
+    _cache_order = collections.deque()
+
+    def request(cls, text, callback):
+        """Call `callback(outline)` with the outline of the UTF-8 `text`,
+        at once if cached, else from the main loop once parsed"""
+        digest = hashlib.sha1(text).hexdigest()
+        outline = cls._cache.get(digest)
+        if outline is not None:
+            callback(outline)
+            return
+        if cls.pool is None:
+            import multiprocessing
+            cls.pool = multiprocessing.Pool(1)
+            # once per session, before the first parse
+            cls.pool.apply_async(pruneOutlineCache,
+                                 (outlineDirectory(),
+                                  ctx['editor.outline_cache_files']))
+        path = os.path.join(outlineDirectory(), digest + '.outline')
+        def parsed(outline):
+            # in a thread of the pool
+            gobject.idle_add(cls._parsed, digest, outline, callback)
+        cls.pool.apply_async(outlineTask, ((path, text),), callback=parsed)
+    request = classmethod(request)
+
+    def _parsed(cls, digest, outline, callback):
+        if digest not in cls._cache:
+            cls._cache[digest] = outline
+            cls._cache_order.append(digest)
+            if len(cls._cache_order) > cls.cache_size:
+                del cls._cache[cls._cache_order.popleft()]
+        callback(outline)
+        return False
+    _parsed = classmethod(_parsed)
+
+
+class OutlinePanel(gtk.ScrolledWindow):
+
+    """Side panel showing the outline of the current document of
+    `editorbook`; activating a symbol moves the cursor to it"""
+
+    labels = {'class': 'class %s', 'function': 'def %s', 'method': 'def %s',
+              'import': 'import %s'}
+
+    def __init__(self, editorbook):
+        gtk.ScrolledWindow.__init__(self)
+        self.editorbook = editorbook
+        self.document = None
+        self._handler_id = None
+        self.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        # label, line, name
+        self.store = gtk.TreeStore(str, int, str)
+        self.tree = gtk.TreeView(self.store)
+        self.tree.set_headers_visible(False)
+        self.tree.append_column(gtk.TreeViewColumn(
+            None, gtk.CellRendererText(), text=0))
+        self.tree.set_search_column(2)
+        self.tree.connect('row-activated', self._cbRowActivated)
+        self.add(self.tree)
+        self.tree.show()
+
+    def documentSelected(self, document):
+        """Show the outline of `document` (or None)"""
+        if self.document is not None:
+            self.document.disconnect(self._handler_id)
+        self.document = document
+        if document is not None:
+            self._handler_id = document.connect('outline-changed',
+                                                self._cbOutlineChanged)
+        self._cbOutlineChanged(document)
+
+    def _cbOutlineChanged(self, document):
+        self.store.clear()
+        if document is None:
+            return
+        parents = [None] # row of each depth
+        for kind, name, line, depth in document.outline:
+            del parents[depth + 1:]
+            parent = parents[min(depth, len(parents) - 1)]
+            row = self.store.append(parent, [self.labels[kind] % name,
+                                             line, name])
+            parents.append(row)
+        self.tree.expand_all()
+
+    def _cbRowActivated(self, tree, path, column):
+        self.document.gotoLine(self.store[path][1])
+        self.document.editor.view.grab_focus()
+
+    def gotoSymbol(self):
+        """Focus the outline with its search entry, to jump to a symbol by
+        typing (part of) its name"""
+        self.tree.grab_focus()
+        self.tree.emit('start-interactive-search')
@@ -0,0 +1,342 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Project file index and the quick-open dialog
+
+The files below the project root ('project.root') are listed by a
+background thread and indexed by the trigrams of their paths. The listing
+is kept under ~/.config/mallet/index along with the mtime of each
+directory, so that later walks only list the directories which changed.
+"""
+
+import os
+import os.path
+import re
+import array
+import bisect
+import heapq
+import fnmatch
+import marshal
+import hashlib
+import threading
+
+import gobject
+import gtk
+
+from mallet.context import ctx
+from mallet.util import atomicWrite
+
+
+class ProjectIndex:
+
+    """Paths of the files below `root`, searchable by fuzzy queries
+
+    @ivar ready: True once the index reflects the tree
+    """
+
+    # bump when the stored format changes
+    version = 1
+
+    def __init__(self, root, ignore=()):
+        """Files and directories whose name matches one of the `ignore`
+        patterns are left out"""
+        self.root = root
+        self.ignore = list(ignore)
+        self.ready = False
+        self._dirs = {} # relative directory -> (mtime, subdirs, files)
+        self._last = None # (query, ids, index) of the last fuzzy match
+        self._set_paths([])
+        self._thread = None
+
+    def _cachePath(self):
+        directory = os.path.join(ctx.app_settings_directory, 'index')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        key = hashlib.md5(self.root).hexdigest()
+        return os.path.join(directory, key + '.index')
+
+    # building
+
+    def refresh(self):
+        """Bring the index up to date in a background thread"""
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._thread = threading.Thread(target=self._refresh)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _refresh(self):
+        if not self._dirs:
+            self._load()
+        dirs = self._walk()
+        if dirs != self._dirs:
+            self._dirs = dirs
+            paths = []
+            for directory in sorted(dirs):
+                for name in dirs[directory][2]:
+                    paths.append(os.path.join(directory, name))
+            self._set_paths(paths)
+            self._store()
+        self.ready = True
+
+    def _ignored(self, name):
+        for pattern in self.ignore:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def _walk(self):
+        """Return the directory table, listing only the directories whose
+        mtime changed"""
+        dirs = {}
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            path = os.path.join(self.root, directory)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            old = self._dirs.get(directory)
+            if old is not None and old[0] == mtime:
+                subdirs, files = old[1], old[2]
+            else:
+                subdirs, files = [], []
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    names = []
+                for name in names:
+                    if self._ignored(name):
+                        continue
+                    full = os.path.join(path, name)
+                    if os.path.islink(full) and os.path.isdir(full):
+                        continue # might loop
+                    if os.path.isdir(full):
+                        subdirs.append(name)
+                    else:
+                        files.append(name)
+                subdirs.sort()
+                files.sort()
+            dirs[directory] = (mtime, subdirs, files)
+            for name in subdirs:
+                pending.append(os.path.join(directory, name))
+        return dirs
+
+    def _set_paths(self, paths):
+        """Index `paths` and make them searchable"""
+        lower = [path.lower() for path in paths]
+        names = [os.path.basename(path) for path in lower]
+        lengths = array.array('I', [len(path) for path in paths])
+        initials = {} # first character of the file name -> ids
+        for nr, name in enumerate(names):
+            try:
+                initials[name[:1]].append(nr)
+            except KeyError:
+                initials[name[:1]] = array.array('I', [nr])
+        trigrams = {}
+        for nr, path in enumerate(lower):
+            for trigram in set([path[i:i+3] for i in xrange(len(path) - 2)]):
+                try:
+                    trigrams[trigram].append(nr)
+                except KeyError:
+                    trigrams[trigram] = array.array('I', [nr])
+        # all paths in one string, for matching them in a single scan
+        blob = '\n'.join(lower) + '\n'
+        starts = [0] # offset of each path in blob
+        for path in lower:
+            starts.append(starts[-1] + len(path) + 1)
+        # replaced at once, for queries from the main loop
+        self._index = (paths, lower, names, lengths, initials, trigrams, blob,
+                       starts)
+
+    def _load(self):
+        try:
+            data = marshal.loads(open(self._cachePath(), 'rb').read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        version, root, ignore, dirs = data
+        if (version, root, ignore) != (self.version, self.root, self.ignore):
+            return
+        self._dirs = dirs
+        paths = []
+        for directory in sorted(dirs):
+            for name in dirs[directory][2]:
+                paths.append(os.path.join(directory, name))
+        self._set_paths(paths)
+
+    def _store(self):
+        data = (self.version, self.root, self.ignore, self._dirs)
+        atomicWrite(self._cachePath(), [marshal.dumps(data)])
+
+    # querying
+
+    def files(self):
+        """Return the absolute paths of the indexed files"""
+        root = self.root
+        return [os.path.join(root, path) for path in self._index[0]]
+
+    def query(self, text, limit=50):
+        """Return up to `limit` paths matching `text`, best first
+
+        Paths whose file name starts with `text` come first, then those
+        containing it in the file name, then anywhere and last those that
+        contain its characters in order.
+        """
+        paths, lower, names, lengths, initials, trigrams, blob, starts = \
+               self._index
+        query = text.lower().replace(' ', '')
+        if not query:
+            return []
+        shortest = lengths.__getitem__
+        if len(query) < 3:
+            found = [nr for nr in initials.get(query[0], ())
+                     if names[nr].startswith(query)]
+            return [paths[nr] for nr in heapq.nsmallest(limit, found, shortest)]
+
+        # substrings, from the trigram index
+        postings = [trigrams.get(query[i:i+3]) for i in range(len(query) - 2)]
+        if None in postings:
+            substring = []
+        else:
+            postings.sort(key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                ids.intersection_update(posting)
+            substring = [nr for nr in ids if query in lower[nr]]
+        prefix, in_name, in_path = [], [], []
+        for nr in substring:
+            name = names[nr]
+            if name.startswith(query):
+                prefix.append(nr)
+            elif query in name:
+                in_name.append(nr)
+            else:
+                in_path.append(nr)
+        result = []
+        for tier in prefix, in_name, in_path:
+            result.extend(heapq.nsmallest(limit - len(result), tier, shortest))
+            if len(result) == limit:
+                return [paths[nr] for nr in result]
+
+        # characters in order
+        fuzzy = self._fuzzy(query, self._index)
+        seen = set(substring)
+        fuzzy = [nr for nr in fuzzy if nr not in seen]
+        result.extend(heapq.nsmallest(limit - len(result), fuzzy, shortest))
+        return [paths[nr] for nr in result]
+
+    def _fuzzy(self, query, index):
+        """Return the ids of the paths containing the characters of
+        `query` in order"""
+        lower, blob, starts = index[1], index[6], index[7]
+        last = self._last
+        if last is not None and last[2] is index and \
+           query.startswith(last[0]):
+            # narrow the matches of the previous keystroke
+            pattern = re.compile('.*?'.join([re.escape(c) for c in query]))
+            ids = [nr for nr in last[1] if pattern.search(lower[nr])]
+        else:
+            # "a[^\nb]*b[^\nc]*c[^\n]*": found without backtracking as
+            # each character is its first occurrence, and at most once per
+            # line as the match extends to the end of the line
+            parts = [re.escape(query[0])]
+            for c in query[1:]:
+                parts.append('[^\n%s]*%s' % (re.escape(c), re.escape(c)))
+            parts.append('[^\n]*')
+            pattern = re.compile(''.join(parts))
+            find_line = bisect.bisect_right
+            ids = [find_line(starts, match.start()) - 1
+                   for match in pattern.finditer(blob)]
+        self._last = (query, ids, index)
+        return ids
+
+
+class QuickOpen(gtk.Dialog):
+
+    """Popup finding project files as the query is typed; the chosen file
+    is passed to `open_callback(filename)`"""
+
+    limit = 50
+
+    def __init__(self, index, open_callback, parent=None):
+        gtk.Dialog.__init__(self, 'Quick Open', parent,
+                            gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT)
+        self.index = index
+        self.open_callback = open_callback
+        self.set_default_size(500, 400)
+        self.entry = gtk.Entry()
+        self.store = gtk.ListStore(str)
+        self.tree = gtk.TreeView(self.store)
+        self.tree.set_headers_visible(False)
+        self.tree.append_column(gtk.TreeViewColumn(
+            None, gtk.CellRendererText(), text=0))
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.add(self.tree)
+        self.vbox.pack_start(self.entry, False)
+        self.vbox.pack_start(scrolled, True)
+
+        self.entry.connect('changed', self._cbChanged)
+        self.entry.connect('key-press-event', self._cbKeyPress)
+        self.entry.connect('activate', self._cbActivate)
+        self.tree.connect('row-activated', self._cbActivate)
+        self._timer_id = None
+        if not index.ready:
+            # show the matches once indexing is done
+            self._timer_id = gobject.timeout_add(200, self._cbWaitReady)
+        self.connect('destroy', self._cbDestroy)
+        self.connect('response', lambda dialog, response: dialog.destroy())
+        self.vbox.show_all()
+
+    def _cbWaitReady(self):
+        if not self.index.ready:
+            return True
+        self._timer_id = None
+        self._cbChanged(self.entry)
+        return False
+
+    def _cbDestroy(self, widget):
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+
+    def _cbChanged(self, entry):
+        self.store.clear()
+        for path in self.index.query(entry.get_text(), self.limit):
+            self.store.append([path])
+        if len(self.store):
+            self.tree.set_cursor((0,))
+
+    def _cbKeyPress(self, entry, event):
+        key = gtk.gdk.keyval_name(event.keyval)
+        if key not in ('Up', 'Down') or not len(self.store):
+            return False
+        path, column = self.tree.get_cursor()
+        row = path and path[0] or 0
+        if key == 'Up':
+            row = max(row - 1, 0)
+        else:
+            row = min(row + 1, len(self.store) - 1)
+        self.tree.set_cursor((row,))
+        return True
+
+    def _cbActivate(self, *args):
+        path, column = self.tree.get_cursor()
+        if path is None:
+            return
+        filename = os.path.join(self.index.root, self.store[path][0])
+        self.destroy()
+        self.open_callback(filename)
@@ -0,0 +1,392 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Find in files
+
+The project files are searched by a pool of processes, one per core. A
+thread collects their hits and passes them to the main loop in batches,
+where they are listed in the `FindResults` panel. The text of modified
+documents is searched instead of their files.
+"""
+
+import os
+import os.path
+import re
+import mmap
+import time
+import threading
+import multiprocessing
+
+import gobject
+import gtk
+
+from mallet.context import ctx
+
+
+# compiled patterns of the pool process
+_patterns = {}
+
+def searchFile(task):
+    """Return (filename, [(line, text), ...]) of the lines of a file that
+    match. Run by the pool processes; `task` is (filename, text, pattern,
+    flags, max_size) where text is None to search the file. Files of more
+    than `max_size` bytes are memory mapped instead of read"""
+    filename, text, pattern, flags, max_size = task
+    mapped = False
+    if text is None:
+        try:
+            f = open(filename, 'rb')
+            try:
+                text = f.read(8192)
+                if '\0' in text:
+                    return filename, [] # binary
+                if os.fstat(f.fileno()).st_size > max_size:
+                    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    mapped = True
+                else:
+                    text += f.read()
+            finally:
+                f.close()
+        except (IOError, OSError, mmap.error):
+            return filename, []
+    try:
+        return filename, _searchText(text, mapped, pattern, flags)
+    finally:
+        if mapped:
+            text.close()
+
+
+def searchFiles(tasks):
+    """Return the `searchFile` results of a list of tasks"""
+    return [searchFile(task) for task in tasks]
+
+
+def _searchText(text, mapped, pattern, flags):
+    """Return the [(line, text), ...] of the lines of `text` (a string or
+    a map if `mapped`) that match"""
+    try:
+        regex = _patterns[pattern, flags]
+    except KeyError:
+        regex = _patterns[pattern, flags] = re.compile(pattern, flags)
+    hits = []
+    line = 1
+    pos = 0
+    end = -1
+    for match in regex.finditer(text):
+        start = match.start()
+        if start <= end:
+            continue # one hit per line
+        if mapped:
+            # a map has no count
+            line += text[pos:start].count('\n')
+        else:
+            line += text.count('\n', pos, start)
+        pos = start
+        begin = text.rfind('\n', 0, start) + 1
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        hits.append((line, text[begin:end][:200].decode('utf-8', 'replace')
+                                                 .encode('utf-8')))
+    return hits
+
+
+class FileSearch:
+
+    """Search `filenames` (and the `texts` {filename: text} of modified
+    documents) for the regular expression `pattern`
+
+    `hits_callback([(filename, line, text), ...])` is called in the main
+    loop as hits come in, `done_callback(completed)` once at the end.
+    """
+
+    # shared by all searches; created at startup by `getPool`, before
+    # the GTK threads, and again after a search is cancelled
+    pool = None
+    # seconds between batches of hits
+    batch_delay = 0.1
+    # files given to a pool process at once
+    chunk_size = 16
+
+    def __init__(self, filenames, texts, pattern, flags,
+                 hits_callback, done_callback):
+        self.filenames = filenames
+        self.texts = texts
+        self.pattern = pattern
+        self.flags = flags
+        self.hits_callback = hits_callback
+        self.done_callback = done_callback
+        self.cancelled = False
+        self.nr_hits = 0
+        # whether the pool is done with this search; set under the lock so
+        # that either cancel or _run decides the fate of the pool
+        self._done = False
+        self._lock = threading.Lock()
+        self._pool = self.getPool()
+        self._thread = threading.Thread(target=self._run, args=(self._pool,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def getPool(cls):
+        if cls.pool is None:
+            cls.pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        return cls.pool
+    getPool = classmethod(getPool)
+
+    def _tasks(self):
+        max_size = ctx['editor.large_file_threshold']
+        texts = self.texts.copy()
+        # only files named like a modified document may be one
+        names = set([os.path.basename(path) for path in texts])
+        for filename in self.filenames:
+            text = None
+            if os.path.basename(filename) in names:
+                text = texts.pop(os.path.realpath(filename), None)
+            yield filename, text, self.pattern, self.flags, max_size
+        # modified documents outside the project
+        for filename, text in texts.items():
+            yield filename, text, self.pattern, self.flags, max_size
+
+    def _chunks(self):
+        # chunked here: the iterator of a chunked imap_unordered has no
+        # timeout
+        chunk = []
+        for task in self._tasks():
+            chunk.append(task)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _run(self, pool):
+        max_hits = ctx['editor.find_max_hits']
+        batch = []
+        sent = time.time()
+        completed = True
+        results = pool.imap_unordered(searchFiles, self._chunks())
+        while True:
+            try:
+                # cancel terminates the pool, which would never answer
+                chunk = results.next(self.batch_delay)
+            except multiprocessing.TimeoutError:
+                if self.cancelled:
+                    completed = False
+                    break
+                continue
+            except StopIteration:
+                break
+            if self.cancelled:
+                completed = False
+                break
+            for filename, hits in chunk:
+                for line, text in hits:
+                    batch.append((filename, line, text))
+            if self.nr_hits + len(batch) >= max_hits:
+                del batch[max_hits - self.nr_hits:]
+                completed = False
+                break
+            if batch and time.time() - sent > self.batch_delay:
+                self._send(batch)
+                batch = []
+                sent = time.time()
+        self._lock.acquire()
+        try:
+            self._done = True
+            # if cancelled, cancel terminated the pool
+            stop = not completed and not self.cancelled
+        finally:
+            self._lock.release()
+        if stop:
+            # stop the processes working on the remaining files
+            if FileSearch.pool is pool:
+                FileSearch.pool = None
+            pool.terminate()
+        self._send(batch)
+        gobject.idle_add(self._finish, completed)
+
+    def _send(self, batch):
+        self.nr_hits += len(batch)
+        gobject.idle_add(self._post, batch)
+
+    def _post(self, batch):
+        if not self.cancelled and batch:
+            self.hits_callback(batch)
+        return False
+
+    def _finish(self, completed):
+        if not self.cancelled:
+            self.done_callback(completed)
+        return False
+
+    def cancel(self):
+        """Stop searching; no more callbacks are made"""
+        self._lock.acquire()
+        try:
+            self.cancelled = True
+            # once done, the pool is idle and kept
+            stop = not self._done
+        finally:
+            self._lock.release()
+        if not stop:
+            return
+        # the next search must not use the pool being terminated
+        if FileSearch.pool is self._pool:
+            FileSearch.pool = None
+        # stops workers stuck on a slow pattern; joining them is left to a
+        # thread, not the main loop
+        terminator = threading.Thread(target=self._pool.terminate)
+        terminator.setDaemon(True)
+        terminator.start()
+
+
+class FindResults(gtk.VBox):
+
+    """Panel listing the hits of a `FileSearch`; activating a hit shows
+    its line through `editorbook`"""
+
+    # last search, to fill in the dialog
+    last_pattern = ''
+    last_regex = False
+    last_case = False
+
+    def __init__(self, editorbook):
+        gtk.VBox.__init__(self)
+        self.editorbook = editorbook
+        self.search = None
+        self.label = gtk.Label()
+        self.label.set_alignment(0, 0.5)
+        self.stop = gtk.Button(stock=gtk.STOCK_STOP)
+        self.stop.connect('clicked', lambda button: self.cancel())
+        close = gtk.Button(stock=gtk.STOCK_CLOSE)
+        close.connect('clicked', self._cbClose)
+        header = gtk.HBox()
+        header.pack_start(self.label, True)
+        header.pack_start(self.stop, False)
+        header.pack_start(close, False)
+
+        # file shown, line, text, file
+        self.store = gtk.ListStore(str, int, str, str)
+        self.tree = gtk.TreeView(self.store)
+        for title, column in (('File', 0), ('Line', 1), ('Text', 2)):
+            self.tree.append_column(gtk.TreeViewColumn(
+                title, gtk.CellRendererText(), text=column))
+        self.tree.connect('row-activated', self._cbRowActivated)
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.add(self.tree)
+        self.pack_start(header, False)
+        self.pack_start(scrolled, True)
+        header.show_all()
+        scrolled.show_all()
+
+    def find(self, filenames, texts, pattern, flags, root=None):
+        """Start searching, listing file names relative to `root`"""
+        self.cancel()
+        self.store.clear()
+        self.root = root
+        self.label.set_text('Searching ...')
+        self.stop.set_sensitive(True)
+        self.show()
+        self.search = FileSearch(filenames, texts, pattern, flags,
+                                 self._cbHits, self._cbDone)
+
+    def showHits(self, title, hits, root=None):
+        """List `hits` [(filename, line, text), ...] found by other means
+        than searching (eg: cross-references)"""
+        self.cancel()
+        self.store.clear()
+        self.root = root
+        self._cbHits(hits)
+        self.stop.set_sensitive(False)
+        self.label.set_text('%s: %d found' % (title, len(self.store)))
+        self.show()
+
+    def cancel(self):
+        if self.search is not None:
+            self.search.cancel()
+            self._cbDone(False)
+
+    def _cbHits(self, hits):
+        root = self.root
+        for filename, line, text in hits:
+            shown = filename
+            if root and filename.startswith(root + os.sep):
+                shown = filename[len(root) + 1:]
+            self.store.append([shown, line, text, filename])
+        self.label.set_text('Searching ... %d found' % len(self.store))
+
+    def _cbDone(self, completed):
+        self.search = None
+        self.stop.set_sensitive(False)
+        if completed:
+            self.label.set_text('%d found' % len(self.store))
+        else:
+            self.label.set_text('%d found (stopped)' % len(self.store))
+
+    def _cbClose(self, button):
+        self.cancel()
+        self.hide()
+
+    def _cbRowActivated(self, tree, path, column):
+        row = self.store[path]
+        document = self.editorbook.openFile(row[3])
+        document.setCursorLine(row[1] - 1)
+
+    def ask(self, parent=None):
+        """Ask for the search; return (pattern, flags) or None"""
+        dlg = gtk.Dialog('Find in Files', parent,
+                         gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                         (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                          gtk.STOCK_FIND, gtk.RESPONSE_OK))
+        dlg.set_default_response(gtk.RESPONSE_OK)
+        entry = gtk.Entry()
+        entry.set_text(FindResults.last_pattern)
+        entry.set_activates_default(True)
+        regex = gtk.CheckButton('_Regular expression')
+        regex.set_active(FindResults.last_regex)
+        case = gtk.CheckButton('Match _case')
+        case.set_active(FindResults.last_case)
+        for widget in entry, regex, case:
+            dlg.vbox.pack_start(widget, False)
+        dlg.vbox.show_all()
+        while True:
+            if dlg.run() != gtk.RESPONSE_OK or not entry.get_text():
+                dlg.destroy()
+                return None
+            pattern = entry.get_text()
+            FindResults.last_pattern = pattern
+            FindResults.last_regex = regex.get_active()
+            FindResults.last_case = case.get_active()
+            if not regex.get_active():
+                pattern = re.escape(pattern)
+            flags = re.M
+            if not case.get_active():
+                flags |= re.I
+            try:
+                re.compile(pattern, flags)
+            except re.error, e:
+                msg = gtk.MessageDialog(parent=dlg,
+                                        flags=gtk.DIALOG_MODAL,
+                                        type=gtk.MESSAGE_ERROR,
+                                        buttons=gtk.BUTTONS_OK,
+                                        message_format="Invalid regular "
+                                        "expression: %s" % e)
+                msg.run()
+                msg.destroy()
+                continue
+            dlg.destroy()
+            return pattern, flags
@@ -0,0 +1,242 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Swap files, for recovering unsaved changes after a crash
+
+A swap file is an append-only log of marshalled records. The header names
+the file the edits apply to (the base), identified by its `fileSignature`
+or empty if the signature is None. The edits follow as
+
+    ('i', offset, text)     text inserted at character offset
+    ('d', start, end)       characters start to end deleted
+    ('s', text)             the whole text (queued once the log grows big)
+
+The main loop only queues records; they are written by worker threads.
+Once the log grows big, the main loop queues a snapshot of the text and
+the worker replaces the log with it, so the log never has to be replayed
+while editing.
+"""
+
+import os
+import os.path
+import hashlib
+import glob
+import array
+import marshal
+import threading
+import collections
+
+from mallet.context import ctx
+from mallet.util import atomicWrite
+from mallet.watcher import fileSignature
+
+
+def swapDirectory():
+    directory = os.path.join(ctx.app_settings_directory, 'swap')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+class SwapError(Exception):
+
+    """Swap file cannot be replayed (eg: its base file changed)"""
+
+
+class SwapFile:
+
+    """Log of the edits made to a document since it was last unmodified
+
+    `inserted`, `deleted`, `snapshot` and `wantsSnapshot` are called from
+    the main loop, `flush` and `discard` from a worker thread.
+    """
+
+    _serials = iter(xrange(1 << 31))
+
+    def __init__(self, filename, signature):
+        """`signature` is the `fileSignature` of `filename` the edits
+        apply to, or None if they apply to an empty text"""
+        if filename:
+            key = hashlib.md5(filename).hexdigest()
+        else:
+            key = 'unnamed'
+        self.path = os.path.join(swapDirectory(), '%s-%d-%d.swp' %
+                                 (key, os.getpid(), self._serials.next()))
+        self.filename = filename
+        self.signature = signature
+        self.pending = collections.deque()
+        self.size = 0
+        self._lock = threading.Lock()
+        self._discarded = False
+        self._snapshot_pending = False
+
+    def inserted(self, offset, text):
+        self.pending.append(('i', offset, text))
+
+    def deleted(self, start, end):
+        self.pending.append(('d', start, end))
+
+    def snapshot(self, text):
+        """Queue the whole UTF-8 `text`; the log written so far is replaced
+        on the next flush"""
+        self._snapshot_pending = True
+        self.pending.append(('s', text))
+
+    def wantsSnapshot(self):
+        """Return True if the log grew beyond 'editor.swap_compact_size'
+        bytes and no snapshot is queued yet"""
+        return not self._snapshot_pending and \
+               self.size > ctx['editor.swap_compact_size']
+
+    def _header(self, signature):
+        return marshal.dumps(('base', self.filename, signature, os.getpid()))
+
+    def flush(self):
+        """Append the pending records, or write a new log from the last
+        pending snapshot"""
+        self._lock.acquire()
+        try:
+            if self._discarded or not self.pending:
+                return
+            records = []
+            snapshot = None
+            while self.pending:
+                record = self.pending.popleft()
+                if record[0] == 's':
+                    snapshot = len(records)
+                records.append(record)
+            if snapshot is not None:
+                # the snapshot holds the edits before it, and the base file
+                # no longer matters
+                data = [self._header(None)]
+                data.extend([marshal.dumps(record)
+                             for record in records[snapshot:]])
+                atomicWrite(self.path, data)
+                self.size = sum([len(chunk) for chunk in data])
+                self._snapshot_pending = False
+                return
+            if self.size:
+                f = open(self.path, 'ab')
+            else:
+                f = open(self.path, 'wb')
+                header = self._header(self.signature)
+                f.write(header)
+                self.size = len(header)
+            try:
+                for record in records:
+                    data = marshal.dumps(record)
+                    f.write(data)
+                    self.size += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+    def discard(self):
+        """Drop the log, the document is saved or closed"""
+        self._lock.acquire()
+        try:
+            self._discarded = True
+            self.pending.clear()
+            if self.size:
+                os.unlink(self.path)
+        finally:
+            self._lock.release()
+
+
+def _readHeader(f, path):
+    try:
+        tag, filename, signature, pid = marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+        raise SwapError, 'corrupt swap file %s' % path
+    return filename, signature, pid
+
+
+def swapFileOwner(path):
+    """Return the pid of the process which wrote the swap file `path`"""
+    f = open(path, 'rb')
+    try:
+        return _readHeader(f, path)[2]
+    finally:
+        f.close()
+
+
+def readSwapFile(path):
+    """Replay the swap file `path`. Return (filename, pid, text) where
+    `filename` is None for an unnamed document and `pid` is of the process
+    which wrote it. Raise SwapError if the base file changed"""
+    f = open(path, 'rb')
+    try:
+        filename, signature, pid = _readHeader(f, path)
+        if signature is None:
+            text = u''
+        elif fileSignature(filename) == signature:
+            text = open(filename, 'rb').read().decode('utf-8')
+        else:
+            raise SwapError, '%s changed since %s was written' % (filename, path)
+        # edited in place rather than copied for each record
+        chars = array.array('u', text)
+        while True:
+            try:
+                record = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                # end, or a record cut short by the crash
+                break
+            if record[0] == 'i':
+                offset = record[1]
+                chars[offset:offset] = array.array('u',
+                                                   record[2].decode('utf-8'))
+            elif record[0] == 'd':
+                del chars[record[1]:record[2]]
+            else:
+                chars = array.array('u', record[1].decode('utf-8'))
+    finally:
+        f.close()
+    return filename, pid, chars.tounicode()
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def recoverableSwapFiles():
+    """Return (paths, filename, text) for each file with swap files left
+    behind by mallet processes that are no longer running. `text` is
+    replayed from the newest of `paths`"""
+    found = {}
+    for path in glob.glob(os.path.join(swapDirectory(), '*.swp')):
+        try:
+            pid = swapFileOwner(path)
+            # the logs of a running mallet are not replayed
+            if pid == os.getpid() or _running(pid):
+                continue
+            filename, pid, text = readSwapFile(path)
+        except (SwapError, IOError, UnicodeError):
+            continue
+        found.setdefault(filename or path, []).append(
+            (os.path.getmtime(path), path, filename, text))
+    result = []
+    for entries in found.values():
+        entries.sort()
+        mtime, path, filename, text = entries[-1]
+        result.append(([entry[1] for entry in entries], filename, text))
+    return result
@@ -0,0 +1,230 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Bounded undo history, optionally kept on disk between sessions
+
+Edits are recorded as ('i', offset, text) or ('d', offset, text), offset
+counting characters and text being UTF-8. The records of one user action
+form a group; consecutive typed (or erased) characters are merged into a
+single record, so that a burst of typing costs one record and is undone at
+once. The oldest groups are dropped when the history exceeds its budget.
+
+A history is stored per file along with the SHA-1 of the text it ends at,
+and is only loaded again for a file with that very text.
+"""
+
+import os
+import os.path
+import time
+import marshal
+import hashlib
+import collections
+
+from mallet.context import ctx
+from mallet.util import atomicWrite
+from mallet.watcher import fileSignature
+
+
+class UndoStack:
+
+    """Undo and redo groups of edit records within `budget` bytes
+
+    @ivar size: Estimated bytes held by the records
+    """
+
+    # seconds between keystrokes still merged into one record
+    burst_time = 1.0
+    # estimated bytes used by a record besides its text
+    record_overhead = 64
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self._undo = collections.deque() # [serial, time, records, size]
+        self._redo = []
+        self._current = None # group of the running user action
+        self._depth = 0
+        self._next_serial = 1
+        self._base = 0       # serial of the state before the oldest group
+        self._saved = 0      # serial of the state which was saved
+
+    # recording
+
+    def beginGroup(self):
+        self._depth += 1
+        if self._depth == 1:
+            self._current = [0, time.time(), [], 0]
+
+    def endGroup(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        group, self._current = self._current, None
+        if not group[2]:
+            return
+        if self._undo and self._merge(self._undo[-1], group):
+            return
+        group[0] = self._next_serial
+        self._next_serial += 1
+        self._undo.append(group)
+        self._evict()
+
+    def inserted(self, offset, text):
+        self._record(('i', offset, text))
+
+    def deleted(self, offset, text):
+        self._record(('d', offset, text))
+
+    def _record(self, record):
+        for group in self._redo:
+            self.size -= group[3]
+        self._redo = []
+        if self._current is None:
+            # not within a user action, a group of its own
+            self.beginGroup()
+            self._record(record)
+            self.endGroup()
+            return
+        group = self._current
+        cost = len(record[2]) + self.record_overhead
+        group[2].append(record)
+        group[3] += cost
+        self.size += cost
+
+    def _merge(self, previous, group):
+        """Merge `group` into `previous` if both are a single typed or
+        erased run of characters. Return True if merged"""
+        if len(previous[2]) != 1 or len(group[2]) != 1 or \
+           previous[0] == self._saved or \
+           group[1] - previous[1] > self.burst_time:
+            return False
+        kind, offset, text = group[2][0]
+        prev_kind, prev_offset, prev_text = previous[2][0]
+        if kind != prev_kind or '\n' in text:
+            return False
+        if kind == 'i' and \
+           offset == prev_offset + len(prev_text.decode('utf-8')):
+            record = ('i', prev_offset, prev_text + text)
+        elif kind == 'd' and offset == prev_offset:
+            # Delete key
+            record = ('d', offset, prev_text + text)
+        elif kind == 'd' and \
+             offset + len(text.decode('utf-8')) == prev_offset:
+            # BackSpace
+            record = ('d', offset, text + prev_text)
+        else:
+            return False
+        previous[1] = group[1]
+        previous[2] = [record]
+        previous[3] += group[3] - self.record_overhead
+        self.size -= self.record_overhead
+        return True
+
+    def _evict(self):
+        """Drop the oldest groups until within budget"""
+        while self.size > self.budget and len(self._undo) > 1:
+            group = self._undo.popleft()
+            self.size -= group[3]
+            self._base = group[0]
+
+    # undoing
+
+    def canUndo(self):
+        return bool(self._undo)
+
+    def canRedo(self):
+        return bool(self._redo)
+
+    def undo(self):
+        """Return the records to revert, newest first"""
+        group = self._undo.pop()
+        self._redo.append(group)
+        return group[2][::-1]
+
+    def redo(self):
+        """Return the records to apply again, oldest first"""
+        group = self._redo.pop()
+        self._undo.append(group)
+        return group[2]
+
+    def _top(self):
+        if self._undo:
+            return self._undo[-1][0]
+        return self._base
+
+    def markSaved(self):
+        """Remember the current state as the one in the file"""
+        self._saved = self._top()
+
+    def atSaved(self):
+        """Is the text that of the file again?"""
+        return self._top() == self._saved
+
+    # persistence
+
+    def dump(self):
+        """Return the history as marshallable data"""
+        return (self._base, self._next_serial,
+                [tuple(group) for group in self._undo],
+                [tuple(group) for group in self._redo])
+
+    def load(cls, data, budget):
+        """Create a stack from `dump` data, its end marked as saved"""
+        stack = cls(budget)
+        stack._base, stack._next_serial, undo, redo = data
+        stack._undo.extend([list(group) for group in undo])
+        stack._redo = [list(group) for group in redo]
+        for group in stack._undo:
+            stack.size += group[3]
+        for group in stack._redo:
+            stack.size += group[3]
+        stack._evict()
+        stack.markSaved()
+        return stack
+    load = classmethod(load)
+
+
+def undoDirectory():
+    directory = os.path.join(ctx.app_settings_directory, 'undo')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def _undoPath(filename):
+    key = hashlib.md5(os.path.realpath(filename)).hexdigest()
+    return os.path.join(undoDirectory(), key + '.undo')
+
+
+def storeHistory(filename, signature, data):
+    """Store `UndoStack.dump` data of `filename`, unless its
+    `fileSignature` is no longer `signature`"""
+    if fileSignature(filename) != signature:
+        return
+    digest = hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+    atomicWrite(_undoPath(filename), [marshal.dumps((digest, data))])
+
+
+def loadHistory(filename, text):
+    """Return the stored `UndoStack.dump` data of `filename` if it was
+    stored for `text`, else None"""
+    try:
+        digest, data = marshal.loads(open(_undoPath(filename), 'rb').read())
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if digest != hashlib.sha1(text).hexdigest():
+        return None
+    return data
@@ -15,3 +15,295 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 """Python utility module"""
+
+import sys
+import os
+import os.path
+import stat
+import time
+import tempfile
+import threading
+import Queue
+import difflib
+
+
+class _PathNode(object):
+
+    """Node of the reversed-path trie used by `UniqueNames`
+
+    @ivar children: directory component -> child node
+    @ivar paths: full paths which pass through this node
+    """
+
+    __slots__ = ('children', 'paths')
+
+    def __init__(self):
+        self.children = {}
+        self.paths = set()
+
+
+class UniqueNames:
+
+    """Map each filename to unique (human readable) short versions such that no
+    two filename in a 'set' has the same short version.
+    
+    eg:
+    /root/a/file.py and /root/a/open.py map to file.py and open.py
+    while
+    /root/a/file.py and /root/b/file.py map to file.py[a] and file.py[b]
+
+    Paths sharing a basename are kept in a trie of their directory
+    components, read from the leaf directory upward. The identity of a path
+    is the component at the shallowest trie node it does not share with any
+    other path, so adding or removing a path only walks its own depth.
+    """
+    
+    def __init__(self):
+        self.tries = {}       # file.py -> root _PathNode
+        self.components = {}  # path -> reversed directory components
+        self.callbacks = {}   # path -> shortname_changed_callback
+        self.uniquename = {}  # path -> (basename, identity)
+        
+    def addPath(self, newpath, shortname_changed_callback):
+        """Add newpath to set, notifying any change in shortnames for other paths"""
+        if newpath in self.components:
+            self.callbacks[newpath] = shortname_changed_callback
+            return
+        basename = os.path.basename(newpath)
+        parts = os.path.dirname(newpath).split(os.path.sep)
+        parts.reverse()
+        self.components[newpath] = parts
+        self.callbacks[newpath] = shortname_changed_callback
+
+        node = self.tries.get(basename)
+        if node is None:
+            node = self.tries[basename] = _PathNode()
+        # The first node which had a single path before this one arrived was
+        # where that other path became unique; its identity moves deeper
+        displaced = None
+        depth = -1
+        while True:
+            if displaced is None and len(node.paths) == 1:
+                displaced = (iter(node.paths).next(), depth)
+            node.paths.add(newpath)
+            depth += 1
+            if depth == len(parts):
+                break
+            node = node.children.setdefault(parts[depth], _PathNode())
+
+        self.uniquename[newpath] = None
+        self._update(newpath, basename)
+        if displaced is not None:
+            self._update(displaced[0], basename, displaced[1])
+        
+    def removePath(self, path):
+        """Remove newpath from set, notifying any change in shortnames for other paths"""
+        basename = os.path.basename(path)
+        parts = self.components.pop(path)
+        del self.callbacks[path]
+        del self.uniquename[path]
+
+        # The shallowest node left with a single path is where that path
+        # now becomes unique
+        root = node = self.tries[basename]
+        remaining = None
+        depth = -1
+        while node is not None:
+            node.paths.discard(path)
+            if remaining is None and len(node.paths) == 1:
+                remaining = (iter(node.paths).next(), depth)
+            depth += 1
+            if depth == len(parts):
+                break
+            child = node.children.get(parts[depth])
+            if child is not None and len(child.paths) == 1:
+                # nobody else below this point
+                del node.children[parts[depth]]
+                child = None
+            node = child
+
+        if not root.paths:
+            del self.tries[basename]
+        if remaining is not None:
+            self._update(remaining[0], basename, remaining[1])
+
+    def _update(self, path, basename, depth=-1):
+        """Recompute the identity of `path` walking down from `depth` and
+        notify if it changed"""
+        parts = self.components[path]
+        node = self.tries[basename]
+        for part in parts[:depth + 1]:
+            node = node.children[part]
+        while len(node.paths) > 1 and depth + 1 < len(parts):
+            depth += 1
+            node = node.children[parts[depth]]
+        if depth == -1 or len(node.paths) > 1:
+            # unique by basename, or a prefix of another relative path
+            identity = ''
+        else:
+            identity = parts[depth]
+
+        shortname = (basename, identity)
+        if self.uniquename[path] != shortname:
+            self.uniquename[path] = shortname
+            self.callbacks[path](shortname)
+
+
+# read once: os.umask can only be read by setting it, which would race with
+# files created meanwhile by other threads
+_umask = os.umask(0)
+os.umask(_umask)
+
+def atomicWrite(filename, chunks):
+    """Write the strings of iterable `chunks` to `filename` atomically
+
+    The data is streamed to a temporary file in the same directory, synced
+    to disk and renamed over `filename`; a crash in between leaves the
+    original untouched. The directory is synced too, for the rename to
+    survive a crash. An existing file keeps its permission bits (and
+    owner, when allowed). Symbolic links are followed.
+    """
+    filename = os.path.realpath(filename)
+    directory, basename = os.path.split(filename)
+    try:
+        st = os.stat(filename)
+    except OSError:
+        st = None
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename, dir=directory)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if st is not None:
+            os.chmod(tmpname, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmpname, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+        else:
+            os.chmod(tmpname, 0666 & ~_umask)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        # not supported by some file systems; the data itself is synced
+        pass
+
+
+def splitLines(text):
+    """Split `text` after each newline, keeping the newlines (unlike
+    str.splitlines, only '\\n' ends a line)"""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def lineHunks(old, new):
+    """Return the (i1, i2, j1, j2) hunks which turn the list of lines `old`
+    into `new` when old[i1:i2] is replaced by new[j1:j2] for each
+
+    The common head and tail are skipped before diffing, so that a small
+    edit of a long file is found in time proportional to its length.
+    """
+    head = 0
+    end = min(len(old), len(new))
+    while head < end and old[head] == new[head]:
+        head += 1
+    tail = 0
+    end -= head
+    while tail < end and old[-1-tail] == new[-1-tail]:
+        tail += 1
+    matcher = difflib.SequenceMatcher(None, old[head:len(old)-tail],
+                                      new[head:len(new)-tail], False)
+    return [(i1 + head, i2 + head, j1 + head, j2 + head)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+class WorkerPool:
+
+    """Run functions on a fixed number of daemon threads
+
+    `callback(result, error)` is called in the worker thread when the
+    function returns; `error` is the exception raised, or None. GUI code
+    must hand the result back to the main loop (eg: gobject.idle_add).
+    """
+
+    def __init__(self, nr_workers):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(nr_workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, args=(), callback=None):
+        """Queue `func(*args)` to be run by the next free worker"""
+        self.queue.put((func, args, callback))
+
+    def _work(self):
+        while True:
+            func, args, callback = self.queue.get()
+            try:
+                result = func(*args)
+            except Exception, e:
+                result, error = None, e
+            else:
+                error = None
+            if callback is not None:
+                callback(result, error)
+
+
+class PhaseTimer:
+
+    """Measure the wall clock time of consecutive named phases
+
+    eg:
+    >>> timer.mark('imports')
+    >>> timer.mark('config load')
+    >>> timer.report()
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self, start=None):
+        """Start over, counting from `start` (default: now)"""
+        self.start = self.last = start or time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        """Record the time since the previous mark as `phase`"""
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, out=sys.stderr):
+        for phase, seconds in self.phases:
+            out.write('%-20s %8.1f ms\n' % (phase, seconds * 1000))
+        out.write('%-20s %8.1f ms\n' % ('total', (self.last - self.start) * 1000))
+
+
+# Filled in by bin/mallet and `mallet.main`; see --profile-startup
+startup_timer = PhaseTimer()
+
+
+__all__ = ['UniqueNames', 'atomicWrite', 'splitLines', 'lineHunks',
+           'WorkerPool', 'PhaseTimer', 'startup_timer']
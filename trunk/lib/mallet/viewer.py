@@ -0,0 +1,404 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Read-only viewer for files too large to load into a SourceBuffer
+
+The file is memory mapped and never copied as a whole. A background thread
+builds a sparse index of line offsets; only the lines currently visible are
+decoded and put into a (small) TextBuffer.
+"""
+
+import os
+import mmap
+import array
+import bisect
+import threading
+
+import gobject
+import gtk
+import pango
+
+from mallet.context import ctx
+from mallet.gtkutil import StatusMessage
+
+
+class LineIndex:
+
+    """Sparse index of line start offsets in a memory mapped file
+
+    Only the offset of every `stride`-th line is stored; the lines in
+    between are found by scanning forward from the nearest indexed line.
+    The index is built by a daemon thread, `nr_lines` grows as it goes:
+    the lines before it, and the bytes before the last of `offsets`, are
+    covered by the index.
+
+    The thread reads the map a chunk at a time and checks the size of the
+    file before each chunk: reading past the end of a file truncated
+    meanwhile would kill the process with SIGBUS. It stops indexing then,
+    leaving `complete` False.
+
+    @ivar complete: True once the whole file has been indexed
+    """
+
+    stride = 64
+    # characters of a line returned by getLines
+    max_width = 4096
+    # bytes scanned by the thread between checks of the file size
+    chunk_size = 1 << 20
+
+    def __init__(self, mm, fileno):
+        self.mm = mm
+        self.fileno = fileno
+        self.size = len(mm)
+        self.offsets = array.array('L', [0])
+        self.nr_lines = 1
+        self.complete = False
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._build)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _build(self):
+        find = self.mm.find
+        stride = self.stride
+        size = self.size
+        start = 0
+        nr_lines = 1
+        try:
+            while start < size:
+                if self._cancelled or os.fstat(self.fileno).st_size < size:
+                    return
+                end = min(start + self.chunk_size, size)
+                pos = find('\n', start, end)
+                while pos != -1:
+                    pos += 1
+                    if nr_lines % stride == 0:
+                        # counted first: lines before an offset are covered
+                        self.nr_lines = nr_lines + 1
+                        self.offsets.append(pos)
+                    nr_lines += 1
+                    pos = find('\n', pos, end)
+                start = end
+        except (ValueError, EnvironmentError):
+            # map or file closed underneath us
+            return
+        self.nr_lines = nr_lines
+        self.complete = True
+
+    def cancel(self):
+        """Stop indexing and wait for the thread to exit"""
+        self._cancelled = True
+        self._thread.join()
+
+    def progress(self):
+        """Return the fraction of the file indexed so far"""
+        if self.complete or not self.size:
+            return 1.0
+        return float(self.offsets[-1]) / self.size
+
+    def lineOffset(self, line):
+        """Return offset of first byte of `line` (counted from 0)"""
+        block = min(line / self.stride, len(self.offsets) - 1)
+        rest = line - block * self.stride
+        pos = self.offsets[block]
+        find = self.mm.find
+        for i in xrange(rest):
+            pos = find('\n', pos)
+            if pos == -1:
+                return self.size
+            pos += 1
+        return pos
+
+    def lineAtOffset(self, offset):
+        """Return the line containing byte `offset`"""
+        block = bisect.bisect_right(self.offsets, offset) - 1
+        line = block * self.stride
+        pos = self.offsets[block]
+        find = self.mm.find
+        while True:
+            pos = find('\n', pos, offset)
+            if pos == -1:
+                return line
+            pos += 1
+            line += 1
+
+    def getLines(self, first, count):
+        """Return up to `count` lines starting at `first` as unicode, each
+        clipped to `max_width` characters"""
+        max_width = self.max_width
+        # bytes holding max_width characters at most
+        max_bytes = 4 * max_width
+        mm = self.mm
+        pos = self.lineOffset(first)
+        lines = []
+        for i in xrange(count):
+            end = mm.find('\n', pos)
+            if end == -1:
+                end = self.size
+            line = mm[pos:min(end, pos + max_bytes)].decode('utf-8', 'replace')
+            lines.append(line[:max_width])
+            if end == self.size:
+                break
+            lines.append(u'\n')
+            pos = end + 1
+        return u''.join(lines)
+
+
+class LargeFileViewer(gtk.HBox):
+
+    """Read-only, windowed view of a huge file
+
+    Provides the `buffer`/`view` attributes of `Editor`, but `buffer` only
+    ever holds the lines which fit in the window, clipped to
+    `LineIndex.max_width` characters.
+
+    Reading the map past the end of a file truncated meanwhile would kill
+    the process with SIGBUS, so the size of the file is checked before the
+    map is read (see `mapValid`).
+    """
+
+    editable = False
+
+    def __init__(self):
+        gtk.HBox.__init__(self)
+        self.buffer = gtk.TextBuffer()
+        self.view = gtk.TextView(self.buffer)
+        self.view.set_editable(False)
+        self.view.modify_font(pango.FontDescription(ctx['editor.font_desc']))
+        self.adjustment = gtk.Adjustment(0, 0, 1, 1, 1, 1)
+        self.scrollbar = gtk.VScrollbar(self.adjustment)
+        self.pack_start(self.view, True)
+        self.pack_start(self.scrollbar, False)
+
+        self.file = self.mm = self.index = None
+        self.nr_visible = 1
+        self.status = StatusMessage('line-index')
+        self._timer_id = None
+        # line to go to, or (offset, length) of a match to show, once the
+        # index covers it
+        self._pending_line = None
+        self._pending_match = None
+
+        self.adjustment.connect('value-changed', self._render)
+        self.view.connect('size-allocate', self._cbSizeAllocate)
+        self.view.connect('scroll-event', self._cbScroll)
+        self.view.connect('key-press-event', self._cbKeyPress)
+        watch_id = ctx.watch('editor.font_desc', self._cbConfigChanged)
+        self.connect('destroy', lambda widget: ctx.unwatch(watch_id))
+        self.show_all()
+
+    def _cbConfigChanged(self, var_paths):
+        self.view.modify_font(pango.FontDescription(ctx['editor.font_desc']))
+
+    def openFile(self, filename):
+        # the old index thread must not outlive its map
+        self.close()
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.mm = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            self.mm = ''
+        self.index = LineIndex(self.mm, self.file.fileno())
+        self._pending_line = self._pending_match = None
+        self._timer_id = gobject.timeout_add(250, self._cbIndexProgress)
+        self._update_range()
+        self._render()
+
+    def close(self):
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+            self._timer_id = None
+        self.status.clear()
+        if self.index:
+            self.index.cancel()
+        if self.mm:
+            self.mm.close()
+        if self.file:
+            self.file.close()
+        self.file = self.mm = self.index = None
+
+    def mapValid(self):
+        """Return False if the file shrank since it was mapped; the map
+        must not be read then, the file is to be opened again"""
+        if self.file is None:
+            # closed
+            return False
+        if not self.mm:
+            return True
+        if os.fstat(self.file.fileno()).st_size >= len(self.mm):
+            return True
+        if not self.index.complete:
+            self.index.cancel()
+        if self._timer_id is not None:
+            gobject.source_remove(self._timer_id)
+            self._timer_id = None
+        self.status.set('%s was truncated, reload it' % self.filename)
+        return False
+
+    def _cbIndexProgress(self):
+        if not self.mapValid():
+            return False
+        self._update_range()
+        if self._pending_line is not None:
+            self.gotoLine(self._pending_line)
+        elif self._pending_match is not None:
+            self.showMatch(*self._pending_match)
+        if self.index.complete:
+            self.status.clear()
+            self._timer_id = None
+            return False
+        self.status.set('Indexing lines of %s ... %d%%' %
+                        (self.filename, 100 * self.index.progress()))
+        return True
+
+    def _update_range(self):
+        if self.index is None:
+            return
+        adj = self.adjustment
+        adj.upper = max(self.index.nr_lines, 1)
+        adj.page_size = self.nr_visible
+        adj.page_increment = max(self.nr_visible - 1, 1)
+        adj.changed()
+
+    def _cbSizeAllocate(self, view, allocation):
+        layout = view.create_pango_layout('X')
+        line_height = max(layout.get_pixel_size()[1], 1)
+        nr_visible = max(allocation.height / line_height, 1)
+        if nr_visible != self.nr_visible:
+            self.nr_visible = nr_visible
+            self._update_range()
+            self._render()
+
+    def _cbScroll(self, view, event):
+        step = 3
+        if event.direction == gtk.gdk.SCROLL_UP:
+            self.scrollTo(self.topLine() - step)
+        elif event.direction == gtk.gdk.SCROLL_DOWN:
+            self.scrollTo(self.topLine() + step)
+        return True
+
+    def _cbKeyPress(self, view, event):
+        key = gtk.gdk.keyval_name(event.keyval)
+        top = self.topLine()
+        if key == 'Page_Up':
+            self.scrollTo(top - self.nr_visible + 1)
+        elif key == 'Page_Down':
+            self.scrollTo(top + self.nr_visible - 1)
+        elif key == 'Up' and self._cursor_line() == 0:
+            self.scrollTo(top - 1)
+        elif key == 'Down' and self._cursor_line() >= self.nr_visible - 1:
+            self.scrollTo(top + 1)
+        elif key == 'Home' and event.state & gtk.gdk.CONTROL_MASK:
+            self.scrollTo(0)
+        elif key == 'End' and event.state & gtk.gdk.CONTROL_MASK:
+            self.scrollTo(self.index.nr_lines)
+        else:
+            return False
+        return True
+
+    def _cursor_line(self):
+        return self.buffer.get_iter_at_mark(self.buffer.get_insert()).get_line()
+
+    def cursorLine(self):
+        """Return the file line of the cursor"""
+        if self._pending_line is not None:
+            return self._pending_line
+        return self.topLine() + self._cursor_line()
+
+    def _render(self, *args):
+        if self.index is None or not self.mapValid():
+            return
+        text = self.index.getLines(self.topLine(), self.nr_visible)
+        self.buffer.set_text(text)
+        self.buffer.set_modified(False)
+
+    def memoryUsage(self):
+        """Return an estimate of the bytes used by the line index and the
+        visible text; the mapped file is not counted, the system pages it
+        in and out"""
+        if self.index is None:
+            return 0
+        offsets = self.index.offsets
+        return (offsets.buffer_info()[1] * offsets.itemsize + 
+                self.buffer.get_char_count())
+
+    def getLineCount(self):
+        if self.index is None:
+            return 0
+        return self.index.nr_lines
+
+    def topLine(self):
+        """Return the first visible line"""
+        return int(self.adjustment.value)
+
+    def scrollTo(self, line):
+        """Make `line` the first visible line"""
+        upper = self.adjustment.upper - self.adjustment.page_size
+        self.adjustment.set_value(max(0, min(line, upper)))
+
+    def gotoLine(self, line):
+        """Show `line` (counted from 0) and put the cursor on it, once the
+        file is indexed that far"""
+        self._pending_match = None
+        if not self.index.complete and line >= self.index.nr_lines:
+            self._pending_line = line
+            return
+        self._pending_line = None
+        self._update_range()
+        self.scrollTo(line - self.nr_visible / 2)
+        it = self.buffer.get_iter_at_line(line - self.topLine())
+        self.buffer.place_cursor(it)
+
+    def find(self, text, line=None, backward=False):
+        """Search `text` from the beginning of `line` (default: the line
+        after the cursor), select and return the line of the match.
+        If `backward`, search before `line` (default: the cursor line)
+        instead. Return None if not found, or until the file is indexed
+        that far (see `showMatch`)"""
+        pattern = text.encode('utf-8')
+        if backward:
+            if line is None:
+                line = self.cursorLine()
+            offset = self.mm.rfind(pattern, 0, self.index.lineOffset(line))
+        else:
+            if line is None:
+                line = self.cursorLine() + 1
+            offset = self.mm.find(pattern, self.index.lineOffset(line))
+        if offset == -1:
+            return None
+        return self.showMatch(offset, len(text))
+
+    def showMatch(self, offset, length):
+        """Select the `length` characters at byte `offset`, once the file
+        is indexed that far; return their line or None if deferred"""
+        if not self.mapValid():
+            return None
+        if not self.index.complete and offset >= self.index.offsets[-1]:
+            self._pending_line = None
+            self._pending_match = (offset, length)
+            return None
+        found = self.index.lineAtOffset(offset)
+        self.gotoLine(found)
+        column = self.mm[self.index.lineOffset(found):offset]
+        column = min(len(column.decode('utf-8', 'replace')),
+                     self.index.max_width)
+        start = self.buffer.get_iter_at_line_offset(found - self.topLine(), column)
+        end = start.copy()
+        end.forward_chars(length)
+        self.buffer.select_range(start, end)
+        return found
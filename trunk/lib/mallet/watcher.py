@@ -0,0 +1,261 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Notice files changed on disk by other programs
+
+A single thread watches all open files, with inotify on the directories
+holding them where available, otherwise by polling `os.stat` on a timer.
+Directories inotify cannot watch (eg: once out of watches) are polled.
+Changes are coalesced until the disk has been quiet for a moment and then
+posted to the main loop as one batch, so that a 'git checkout' results in
+one callback rather than one per file.
+"""
+
+import os
+import os.path
+import time
+import select
+import struct
+import threading
+
+import gobject
+
+
+def fileSignature(filename):
+    """Return what identifies the current content of `filename`, or None
+    if it does not exist"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class Inotify:
+
+    """Minimal ctypes binding of the Linux inotify API"""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+
+    def __init__(self):
+        """Raise OSError if inotify is not available"""
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            self.fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError), e:
+            raise OSError, 'inotify not available: %s' % e
+        if self.fd < 0:
+            raise OSError, 'inotify_init failed'
+
+    def addWatch(self, directory):
+        """Return the watch descriptor of `directory`, or -1"""
+        return self._add_watch(self.fd, directory, self.mask)
+
+    def removeWatch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def readEvents(self):
+        """Return the pending events as (wd, mask, name) tuples"""
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+            pos += 16
+            name = data[pos:pos+length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+
+    """Watch files and call `changed_callback({filename: signature})` in
+    the main loop with the files whose `fileSignature` changed
+
+    @ivar interval: seconds between polls when inotify is not available
+    @ivar settle_delay: seconds without events before a batch is posted
+    """
+
+    settle_delay = 0.2
+
+    def __init__(self, changed_callback, interval=2.0):
+        self.changed_callback = changed_callback
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._files = {}       # real path -> [filename, signature]
+        self._directories = {} # directory -> [wd or None, number of files]
+        self._wd_dirs = {}     # wd -> directory
+        self._polled = set()   # directories without a watch
+        self._stopped = False
+        try:
+            self._inotify = Inotify()
+        except OSError:
+            self._inotify = None
+        # writing to this pipe wakes the thread up to stop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def watch(self, filename):
+        path = os.path.realpath(filename)
+        directory = os.path.dirname(path)
+        self._lock.acquire()
+        try:
+            if path in self._files:
+                self._files[path][0] = filename
+                return
+            self._files[path] = [filename, fileSignature(path)]
+            if self._inotify is None:
+                return
+            if directory in self._directories:
+                self._directories[directory][1] += 1
+            else:
+                wd = self._inotify.addWatch(directory)
+                if wd < 0:
+                    # out of watches, or not watchable
+                    wd = None
+                    self._polled.add(directory)
+                else:
+                    self._wd_dirs[wd] = directory
+                self._directories[directory] = [wd, 1]
+        finally:
+            self._lock.release()
+
+    def unwatch(self, filename):
+        path = os.path.realpath(filename)
+        directory = os.path.dirname(path)
+        self._lock.acquire()
+        try:
+            if self._files.pop(path, None) is None or self._inotify is None:
+                return
+            entry = self._directories[directory]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._directories[directory]
+                if entry[0] is None:
+                    self._polled.discard(directory)
+                else:
+                    del self._wd_dirs[entry[0]]
+                    self._inotify.removeWatch(entry[0])
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._stopped = True
+        os.write(self._wakeup_w, 'x')
+        self._thread.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _run(self):
+        if self._inotify is None:
+            self._poll()
+        else:
+            self._listen()
+
+    def _poll(self):
+        while not self._stopped:
+            self._lock.acquire()
+            paths = self._files.keys()
+            self._lock.release()
+            self._check(paths)
+            select.select([self._wakeup_r], [], [], self.interval)
+
+    def _polledPaths(self):
+        """Return the files of the directories without a watch"""
+        self._lock.acquire()
+        try:
+            if not self._polled:
+                return []
+            return [path for path in self._files
+                    if os.path.dirname(path) in self._polled]
+        finally:
+            self._lock.release()
+
+    def _listen(self):
+        fds = [self._inotify.fd, self._wakeup_r]
+        pending = set()
+        next_poll = time.time() + self.interval
+        while not self._stopped:
+            if pending:
+                timeout = self.settle_delay
+            elif self._polled:
+                timeout = max(next_poll - time.time(), 0)
+            else:
+                timeout = None
+            readable = select.select(fds, [], [], timeout)[0]
+            if self._stopped:
+                break
+            if time.time() >= next_poll:
+                self._check(self._polledPaths())
+                next_poll = time.time() + self.interval
+            if not readable:
+                # quiet for settle_delay
+                self._check(pending)
+                pending = set()
+                continue
+            events = self._inotify.readEvents()
+            self._lock.acquire()
+            try:
+                for wd, mask, name in events:
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        pending.update(self._files)
+                    elif wd in self._wd_dirs:
+                        path = os.path.join(self._wd_dirs[wd], name)
+                        if path in self._files:
+                            pending.add(path)
+            finally:
+                self._lock.release()
+
+    def _check(self, paths):
+        """Stat `paths` and post those which changed"""
+        signatures = [(path, fileSignature(path)) for path in paths]
+        changed = {}
+        self._lock.acquire()
+        try:
+            for path, signature in signatures:
+                entry = self._files.get(path)
+                if entry is not None and entry[1] != signature:
+                    entry[1] = signature
+                    changed[entry[0]] = signature
+        finally:
+            self._lock.release()
+        if changed:
+            gobject.idle_add(self._post, changed)
+
+    def _post(self, changed):
+        self.changed_callback(changed)
+        return False
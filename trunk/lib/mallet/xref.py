@@ -0,0 +1,333 @@
+# Copyright (C) 2005 Sridhar Ratna <sridhar@users.berlios.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Cross-reference database of the Python files of a project
+
+The definitions (classes, functions, methods and assigned names) and the
+references (names and attributes used) of each file are kept in an SQLite
+database under ~/.config/mallet/xref, so that go-to-definition and
+find-usages are answered by an indexed query.
+
+Files are parsed by a pool of processes, one per core, and only those
+whose mtime or size changed since they were indexed. The results are
+committed every few files along with the file's mtime, so an indexing
+interrupted by quitting goes on where it stopped the next time.
+"""
+
+import os
+import os.path
+import ast
+import time
+import hashlib
+import sqlite3
+import threading
+
+from mallet.context import ctx
+
+
+def xrefDirectory():
+    directory = os.path.join(ctx.app_settings_directory, 'xref')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+class _Collector(ast.NodeVisitor):
+
+    """Collect the definitions and references of a module"""
+
+    def __init__(self):
+        self.definitions = [] # (name, kind, line, scope)
+        self.references = {} # (name, line) -> True
+        self._scope = []      # (name, is class) of the definitions around
+
+    def _define(self, name, kind, node):
+        scope = '.'.join([outer for outer, is_class in self._scope])
+        self.definitions.append((name, kind, node.lineno, scope))
+
+    def visit_ClassDef(self, node):
+        self._define(node.name, 'class', node)
+        for child in node.bases + node.decorator_list:
+            self.visit(child)
+        self._scope.append((node.name, True))
+        for child in node.body:
+            self.visit(child)
+        self._scope.pop()
+
+    def visit_FunctionDef(self, node):
+        if self._scope and self._scope[-1][1]:
+            self._define(node.name, 'method', node)
+        else:
+            self._define(node.name, 'function', node)
+        for child in node.decorator_list:
+            self.visit(child)
+        self.visit(node.args)
+        self._scope.append((node.name, False))
+        for child in node.body:
+            self.visit(child)
+        self._scope.pop()
+
+    def visit_Assign(self, node):
+        # names bound at module or class level
+        if not self._scope or self._scope[-1][1]:
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    self._define(target.id, 'variable', target)
+        self.generic_visit(node)
+
+    def visit_Name(self, node):
+        self.references[node.id, node.lineno] = True
+
+    def visit_Attribute(self, node):
+        self.references[node.attr, node.lineno] = True
+        self.visit(node.value)
+
+
+def indexFile(task):
+    """Return (path, mtime, size, digest, data) for a file to index.
+    Run by the pool processes; `task` is (path, digest of the indexed
+    content or None). `data` is None if the content did not change, else
+    the (definitions, references, line texts) of the file"""
+    path, old_digest = task
+    try:
+        st = os.stat(path)
+        text = open(path, 'rb').read()
+    except (IOError, OSError):
+        return path, None, None, None, ([], [], [])
+    digest = hashlib.sha1(text).hexdigest()
+    if digest == old_digest:
+        # touched, not changed
+        return path, st.st_mtime, st.st_size, digest, None
+    collector = _Collector()
+    try:
+        collector.visit(ast.parse(text, path))
+    except Exception:
+        # syntax errors, but also MemoryError or RuntimeError from deeply
+        # nested code; indexed as empty until it changes
+        return path, st.st_mtime, st.st_size, digest, ([], [], [])
+    # the text of the lines using names, for listing usages
+    lines = text.split('\n')
+    texts = {}
+    for name, line in collector.references:
+        if line not in texts and line <= len(lines):
+            texts[line] = lines[line - 1].strip()[:200].decode(
+                'utf-8', 'replace').encode('utf-8')
+    return (path, st.st_mtime, st.st_size, digest,
+            (collector.definitions, collector.references.keys(),
+             texts.items()))
+
+
+def indexFiles(tasks):
+    """Return the `indexFile` results of a list of tasks"""
+    return [indexFile(task) for task in tasks]
+
+
+class XrefIndex:
+
+    """Cross-reference database of the Python files of a `ProjectIndex`
+
+    Queries are answered in the main loop from what was indexed so far;
+    `update` brings the database up to date in a background thread.
+
+    @ivar indexing: True while updating
+    """
+
+    # files committed at once
+    batch_size = 50
+    # files given to a pool process at once
+    chunk_size = 4
+    # seconds between checks for `stop` while waiting for the pool
+    poll_delay = 0.2
+    # bump when the schema changes
+    version = 1
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL,
+        size INTEGER, digest TEXT);
+    CREATE TABLE IF NOT EXISTS definitions (
+        file INTEGER, name TEXT, kind TEXT, line INTEGER, scope TEXT);
+    CREATE TABLE IF NOT EXISTS refs (file INTEGER, name TEXT, line INTEGER);
+    CREATE TABLE IF NOT EXISTS lines (
+        file INTEGER, line INTEGER, text TEXT, PRIMARY KEY (file, line));
+    CREATE INDEX IF NOT EXISTS definitions_name ON definitions (name);
+    CREATE INDEX IF NOT EXISTS definitions_file ON definitions (file);
+    CREATE INDEX IF NOT EXISTS refs_name ON refs (name);
+    CREATE INDEX IF NOT EXISTS refs_file ON refs (file);
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.root = project.root
+        key = hashlib.md5(self.root).hexdigest()
+        self.path = os.path.join(xrefDirectory(), key + '.sqlite')
+        self.indexing = False
+        self._thread = None
+        self._stopped = False
+        self._db = None # of the main loop; connections are per thread
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.text_factory = str
+        # readers are not blocked by the indexer's transactions
+        db.execute('PRAGMA journal_mode=WAL')
+        if db.execute('PRAGMA user_version').fetchone()[0] != self.version:
+            # indexed by an older mallet, start over
+            for table in ('files', 'definitions', 'refs', 'lines'):
+                db.execute('DROP TABLE IF EXISTS %s' % table)
+            db.execute('PRAGMA user_version = %d' % self.version)
+        db.executescript(self.schema)
+        return db
+
+    # indexing
+
+    def update(self):
+        """Index the new and changed files in a background thread"""
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._stopped = False
+        self.indexing = True
+        self._thread = threading.Thread(target=self._update)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stop indexing; what was committed is kept. Unless `wait`, return
+        at once and let the thread finish by itself"""
+        self._stopped = True
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _update(self):
+        try:
+            self._index()
+        finally:
+            self.indexing = False
+
+    def _index(self):
+        project = self.project
+        while not project.ready:
+            if self._stopped:
+                return
+            time.sleep(0.2)
+        db = self._connect()
+        try:
+            known = {}
+            for path, mtime, size, digest in db.execute(
+                    'SELECT path, mtime, size, digest FROM files'):
+                known[path] = (mtime, size, digest)
+            tasks = []
+            for path in project.files():
+                if self._stopped:
+                    return
+                if not path.endswith('.py'):
+                    continue
+                old = known.pop(path, None)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if old is not None and old[:2] == (st.st_mtime, st.st_size):
+                    continue
+                tasks.append((path, old and old[2]))
+            for path in known:
+                self._remove(db, path)
+            db.commit()
+            if tasks:
+                self._indexFiles(db, tasks)
+        finally:
+            db.close()
+
+    def _indexFiles(self, db, tasks):
+        import multiprocessing
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        chunks = [tasks[i:i + self.chunk_size]
+                  for i in xrange(0, len(tasks), self.chunk_size)]
+        try:
+            pending = 0
+            # not chunked by the pool, whose chunked iterator has no timeout
+            results = pool.imap_unordered(indexFiles, chunks)
+            while not self._stopped:
+                try:
+                    chunk = results.next(self.poll_delay)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                for result in chunk:
+                    self._store(db, result)
+                    pending += 1
+                    if pending >= self.batch_size:
+                        db.commit()
+                        pending = 0
+            db.commit()
+        finally:
+            pool.terminate()
+
+    def _remove(self, db, path):
+        row = db.execute('SELECT id FROM files WHERE path = ?',
+                         (path,)).fetchone()
+        if row is None:
+            return
+        db.execute('DELETE FROM definitions WHERE file = ?', row)
+        db.execute('DELETE FROM refs WHERE file = ?', row)
+        db.execute('DELETE FROM lines WHERE file = ?', row)
+        db.execute('DELETE FROM files WHERE id = ?', row)
+
+    def _store(self, db, result):
+        path, mtime, size, digest, data = result
+        if mtime is None:
+            # vanished meanwhile
+            self._remove(db, path)
+            return
+        if data is None:
+            db.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?',
+                       (mtime, size, path))
+            return
+        self._remove(db, path)
+        file_id = db.execute('INSERT INTO files (path, mtime, size, digest) '
+                             'VALUES (?, ?, ?, ?)',
+                             (path, mtime, size, digest)).lastrowid
+        definitions, references, texts = data
+        db.executemany('INSERT INTO definitions VALUES (?, ?, ?, ?, ?)',
+                       [(file_id, name, kind, line, scope)
+                        for name, kind, line, scope in definitions])
+        db.executemany('INSERT INTO refs VALUES (?, ?, ?)',
+                       [(file_id, name, line) for name, line in references])
+        db.executemany('INSERT INTO lines VALUES (?, ?, ?)',
+                       [(file_id, line, text) for line, text in texts])
+
+    # querying
+
+    def _query(self, sql, args):
+        if self._db is None:
+            self._db = self._connect()
+        return self._db.execute(sql, args).fetchall()
+
+    def definitions(self, name):
+        """Return (path, line, kind, scope) of the definitions of `name`,
+        lines counted from 1"""
+        return self._query('SELECT path, line, kind, scope FROM definitions '
+                           'JOIN files ON files.id = definitions.file '
+                           'WHERE name = ? ORDER BY path, line', (name,))
+
+    def usages(self, name):
+        """Return (path, line, text) of the lines using `name`"""
+        return self._query('SELECT path, refs.line, text FROM refs '
+                           'JOIN files ON files.id = refs.file '
+                           'JOIN lines ON lines.file = refs.file '
+                           'AND lines.line = refs.line '
+                           'WHERE name = ? ORDER BY path, refs.line', (name,))